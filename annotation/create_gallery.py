@@ -3,6 +3,13 @@ from pathlib import Path
 from collections import defaultdict
 
 USERS_OF_INTEREST = ["thagen", "deckersn", "kgutekunst"]
+THUMBNAIL_MAX_WIDTH = 400  # request thumbnails (2x the displayed 200px) from the stitch server; None = full size
+
+def thumbnail_url(url):
+    if THUMBNAIL_MAX_WIDTH is None:
+        return url
+    sep = "&" if "?" in url else "?"
+    return f"{url}{sep}max_width={THUMBNAIL_MAX_WIDTH}"
 
 def bucket_for_id(t, d, k):
     if t != d:
@@ -90,7 +97,7 @@ for dataset, buckets in html_items.items():
         for _id, url, t, d, k in items:
             html.append(
                 f"<div class='item'>"
-                f"<img src='{url}' loading='lazy'><br>"
+                f"<a href='{url}'><img src='{thumbnail_url(url)}' loading='lazy'></a><br>"
                 f"<div class='meta'>id: {_id}<br>"
                 f"thagen={t}, deckersn={d}, kgutekunst={k}</div>"
                 f"</div>"
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPProcessor, CLIPModel, AutoTokenizer
+
+from clip_embedding import MODEL_NAME, ImageDataset, embed_images, embed_texts, embed_images_parallel, embed_texts_parallel
+from embedding_store import EmbeddingCache, hash_files
+
+# -------- CLI --------
+parser = argparse.ArgumentParser(description="Measure how CPU embedding throughput scales with the number of build_index.py worker processes")
+parser.add_argument("--model", default=MODEL_NAME, help="CLIP model name or path")
+parser.add_argument("--images", type=int, default=512, help="Number of synthetic images")
+parser.add_argument("--texts", type=int, default=4096, help="Number of synthetic texts")
+parser.add_argument("--processes", help="Comma-separated process counts to try (default: powers of two up to the number of cores)")
+parser.add_argument("--image-batch-size", type=int, default=64)
+parser.add_argument("--text-batch-size", type=int, default=256)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--output", help="Write the JSON report to this file")
+
+WORDS = "a the cat dog caption funny picture when you my friend finally look at this guy meme why is he so tired".split()
+
+
+def make_synthetic_images(image_dir, count, rng):
+    paths = []
+    for i in range(count):
+        w, h = int(rng.integers(300, 1000)), int(rng.integers(300, 1000))
+        pixels = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        path = os.path.join(image_dir, f"synthetic{i}_image.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def make_synthetic_texts(count, rng):
+    return [" ".join(rng.choice(WORDS, size=int(rng.integers(3, 40)))) + f" #{i}" for i in range(count)]
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    cores = os.cpu_count() or 1
+    if args.processes:
+        process_counts = [int(p) for p in args.processes.split(",")]
+    else:
+        process_counts = [p for p in (1, 2, 4, 8, 16, 32, 64, 128) if p <= cores]
+
+    # the workers are forked from this process, which must not start OpenMP threads before the multi-process runs
+    torch.set_num_threads(1)
+    model = CLIPModel.from_pretrained(args.model).eval()
+    processor = CLIPProcessor.from_pretrained(args.model)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
+
+    work_dir = tempfile.mkdtemp(prefix="embedding_benchmark_")
+    try:
+        image_dir = os.path.join(work_dir, "images")
+        os.makedirs(image_dir)
+        image_paths = make_synthetic_images(image_dir, args.images, rng)
+        image_hashes = hash_files(image_paths)
+        dataset = ImageDataset(image_paths, processor)
+        texts = make_synthetic_texts(args.texts, rng)
+
+        runs = []
+        reference = None
+        for processes in process_counts:
+            cache_dir = os.path.join(work_dir, f"cache_{processes}")
+            image_cache = EmbeddingCache(cache_dir, args.model, "images")
+            text_cache = EmbeddingCache(cache_dir, args.model, "texts")
+
+            start = time.perf_counter()
+            image_embeddings = embed_images_parallel(model, dataset, image_hashes, image_cache, processes, batch_size=args.image_batch_size)
+            image_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            text_embeddings = embed_texts_parallel(model, tokenizer, texts, text_cache, processes, batch_size=args.text_batch_size)
+            text_seconds = time.perf_counter() - start
+
+            text_matrix = np.stack(list(text_embeddings.values()))
+            if reference is None:
+                reference = (image_embeddings, text_matrix)
+            runs.append({
+                "mode": "processes",
+                "processes": processes,
+                "threads_per_process": max(1, cores // processes),
+                "image_seconds": round(image_seconds, 3),
+                "images_per_s": round(args.images / image_seconds, 2),
+                "text_seconds": round(text_seconds, 3),
+                "texts_per_s": round(args.texts / text_seconds, 2),
+                "max_abs_diff": float(max(np.abs(image_embeddings - reference[0]).max(), np.abs(text_matrix - reference[1]).max())),
+            })
+
+        # one process with all cores as intra-op threads, as build_index.py runs without EMBED_PROCESSES
+        torch.set_num_threads(cores)
+        start = time.perf_counter()
+        image_embeddings = embed_images(model, dataset, "cpu", args.image_batch_size, num_workers=0)
+        image_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        text_embeddings = embed_texts(model, tokenizer, texts, "cpu", args.text_batch_size)
+        text_seconds = time.perf_counter() - start
+        runs.append({
+            "mode": "single",
+            "processes": 1,
+            "threads_per_process": cores,
+            "image_seconds": round(image_seconds, 3),
+            "images_per_s": round(args.images / image_seconds, 2),
+            "text_seconds": round(text_seconds, 3),
+            "texts_per_s": round(args.texts / text_seconds, 2),
+            "max_abs_diff": float(max(np.abs(image_embeddings - reference[0]).max(), np.abs(np.stack(list(text_embeddings.values())) - reference[1]).max())),
+        })
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    single = runs[-1]
+    for run in runs:
+        run["image_speedup"] = round(run["images_per_s"] / single["images_per_s"], 2)
+        run["text_speedup"] = round(run["texts_per_s"] / single["texts_per_s"], 2)
+
+    report = {
+        "model": args.model,
+        "cores": cores,
+        "images": args.images,
+        "texts": args.texts,
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
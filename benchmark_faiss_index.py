@@ -0,0 +1,126 @@
+import json
+import time
+import argparse
+import faiss
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from faiss_index import build_index, set_search_params
+
+# -------- CLI --------
+parser = argparse.ArgumentParser(description="Compare FAISS index types on an embedding store: recall@k against the exact index, query latency, build time and memory")
+parser.add_argument("prefix", nargs="?", help="Embedding store to index, e.g. pexels/image_embeddings (default: random unit vectors)")
+parser.add_argument("--query-prefix", help="Embedding store to draw the queries from, e.g. pexels/text_embeddings (default: the indexed store)")
+parser.add_argument("--index-types", nargs="+", default=["IVF1024,Flat", "IVF1024,PQ64", "HNSW32"], help="faiss.index_factory strings to compare against Flat")
+parser.add_argument("--nprobe", default="1,4,16,64", help="Comma-separated nprobe values tried for IVF types")
+parser.add_argument("--ef-search", default="16,64,256", help="Comma-separated efSearch values tried for HNSW types")
+parser.add_argument("--k", type=int, default=10, help="Neighbours per query for recall@k")
+parser.add_argument("--queries", type=int, default=1000, help="Number of queries sampled from the query store")
+parser.add_argument("--latency-queries", type=int, default=200, help="Number of queries searched one at a time to measure latency")
+parser.add_argument("--train-size", type=int, default=65536, help="Vectors sampled to train IVF indices")
+parser.add_argument("--synthetic", type=int, default=100000, help="Number of random vectors when no store is given")
+parser.add_argument("--threads", type=int, help="FAISS OpenMP threads (default: all cores)")
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--output", help="Write the JSON report to this file")
+
+
+def load_vectors(args, rng):
+    if args.prefix is None:
+        # clustered unit vectors, roughly like CLIP embeddings of a photo collection
+        centers = rng.normal(size=(256, 512)).astype("float32")
+        centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+        vectors = centers[rng.integers(0, len(centers), args.synthetic)] + rng.normal(scale=0.05, size=(args.synthetic, 512)).astype("float32")
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors, vectors
+    vectors = EmbeddingStore(args.prefix).float32_matrix()
+    queries = EmbeddingStore(args.query_prefix).float32_matrix() if args.query_prefix else vectors
+    return vectors, queries
+
+
+def search_stats(index, queries, exact_neighbors, k, latency_queries):
+    start = time.perf_counter()
+    _, neighbors = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+
+    recall = np.mean([len(set(row[row >= 0]) & set(exact)) / k for row, exact in zip(neighbors, exact_neighbors)])
+
+    latencies = []
+    for query in queries[:latency_queries]:
+        start = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        f"recall@{k}": round(float(recall), 4),
+        "batch_qps": round(len(queries) / batch_seconds, 1),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    vectors, query_pool = load_vectors(args, rng)
+    query_rows = np.sort(rng.choice(len(query_pool), min(args.queries, len(query_pool)), replace=False))
+    queries = np.ascontiguousarray(query_pool[query_rows])
+    k = min(args.k, len(vectors))
+    print(f"{len(vectors)} vectors of dimension {vectors.shape[1]}, {len(queries)} queries, k={k}")
+
+    results = []
+    start = time.perf_counter()
+    exact = build_index(vectors, "Flat")
+    build_seconds = time.perf_counter() - start
+    _, exact_neighbors = exact.search(queries, k)
+    results.append({
+        "index_type": "Flat",
+        "build_s": round(build_seconds, 2),
+        "memory_mb": round(faiss.serialize_index(exact).nbytes / 1e6, 1),
+        "search": [search_stats(exact, queries, exact_neighbors, k, args.latency_queries)],
+    })
+
+    for index_type in args.index_types:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type, args.train_size, args.seed)
+        build_seconds = time.perf_counter() - start
+
+        if "IVF" in index_type:
+            settings = [{"nprobe": int(n)} for n in args.nprobe.split(",")]
+        elif "HNSW" in index_type:
+            settings = [{"ef_search": int(n)} for n in args.ef_search.split(",")]
+        else:
+            settings = [{}]
+
+        search = []
+        for setting in settings:
+            set_search_params(index, **setting)
+            search.append(dict(setting, **search_stats(index, queries, exact_neighbors, k, args.latency_queries)))
+            print(f"{index_type} {setting}: {search[-1]}")
+
+        results.append({
+            "index_type": index_type,
+            "build_s": round(build_seconds, 2),
+            "memory_mb": round(faiss.serialize_index(index).nbytes / 1e6, 1),
+            "search": search,
+        })
+
+    report = {
+        "store": args.prefix or f"synthetic ({args.synthetic} vectors)",
+        "queries_from": args.query_prefix or args.prefix or "indexed vectors",
+        "vectors": len(vectors),
+        "dimension": int(vectors.shape[1]),
+        "k": k,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from urllib.parse import urlsplit
+import numpy as np
+from PIL import Image
+
+# -------- CLI --------
+parser = argparse.ArgumentParser(description="Replay Doccano im_url values against a local image_stitch_server.py and report latency/throughput as JSON")
+parser.add_argument("jsonl_files", nargs="*", help="doccano_*.jsonl files to replay; synthetic images are used if none are given or their images are missing")
+parser.add_argument("--url", help="Benchmark an already running server at this base url instead of starting one")
+parser.add_argument("--port", type=int, default=8099, help="Port for the locally started server")
+parser.add_argument("--server-args", default="", help="Extra arguments for image_stitch_server.py, e.g. '--render-pool thread --workers 4'")
+parser.add_argument("--requests", type=int, default=1000, help="Total number of requests")
+parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent clients")
+parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause in seconds between two requests of one client (exponentially distributed)")
+parser.add_argument("--repeat-ratio", type=float, default=0.3, help="Probability that a request repeats an already requested url")
+parser.add_argument("--mix", default="single=1,composite=3,thumbnail=1", help="Relative weights of single-image, composite and thumbnail requests")
+parser.add_argument("--thumbnail-width", type=int, default=400, help="max_width used for thumbnail requests")
+parser.add_argument("--synthetic-images", type=int, default=200, help="Number of synthetic images when no real dataset is available")
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--output", help="Write the JSON report to this file")
+parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SYNTHETIC_DATASET = "reddit"
+
+
+def load_request_paths(jsonl_files):
+    paths = []
+    for path in jsonl_files:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                im_url = json.loads(line).get("im_url")
+                if im_url:
+                    url = urlsplit(im_url)
+                    paths.append(url.path + (f"?{url.query}" if url.query else ""))
+    return paths
+
+
+def make_synthetic_images(image_dir, count, rng):
+    """Write `count` noisy gradient JPEGs of varied size and aspect ratio."""
+    names = []
+    for i in range(count):
+        w, h = int(rng.integers(300, 2000)), int(rng.integers(300, 2000))
+        gradient = np.linspace(0, 255, w, dtype=np.float32)[None, :, None]
+        pixels = gradient + rng.normal(0, 25, (h, w, 3)).astype(np.float32)
+        name = f"synthetic{i}_image.jpg"
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(os.path.join(image_dir, name), quality=90)
+        names.append(name)
+    return names
+
+
+def synthetic_request_paths(names, rng):
+    paths = [f"/{SYNTHETIC_DATASET}/{name}" for name in names]
+    for _ in range(len(names)):
+        a, b = rng.choice(len(names), size=2, replace=False)
+        paths.append(f"/{SYNTHETIC_DATASET}/{names[a]}+{SYNTHETIC_DATASET}/{names[b]}")
+    return paths
+
+
+def kind_of(path):
+    return "composite" if "+" in path.split("?")[0] else "single"
+
+
+def start_server(port, server_args, image_dir=None):
+    cmd = [sys.executable, os.path.join(REPO_DIR, "image_stitch_server.py"), "--port", str(port)] + server_args.split()
+    if image_dir is not None:
+        cmd += ["--image-dir", f"{SYNTHETIC_DATASET}={image_dir}"]
+    proc = subprocess.Popen(cmd, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}")
+        try:
+            urllib.request.urlopen(f"{base_url}/metrics", timeout=1).read()
+            return proc, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("Server did not come up")
+
+
+class RequestPicker:
+    """Chooses the next url according to the request mix and the repeat ratio."""
+
+    def __init__(self, paths, mix, repeat_ratio, thumbnail_width, seed):
+        self.rng = random.Random(seed)
+        self.repeat_ratio = repeat_ratio
+        self.lock = threading.Lock()
+
+        by_kind = {"single": [], "composite": []}
+        for path in paths:
+            by_kind[kind_of(path)].append(path)
+        thumbnails = [f"{p}{'&' if '?' in p else '?'}max_width={thumbnail_width}" for p in by_kind["composite"] + by_kind["single"]]
+        by_kind["thumbnail"] = thumbnails
+
+        self.pools = {}
+        for kind, weight in mix.items():
+            if weight > 0 and by_kind.get(kind):
+                fresh = list(by_kind[kind])
+                self.rng.shuffle(fresh)
+                self.pools[kind] = {"weight": weight, "fresh": fresh, "seen": []}
+        if not self.pools:
+            raise ValueError("The request mix selects no available urls")
+
+    def next(self):
+        with self.lock:
+            kinds = list(self.pools)
+            kind = self.rng.choices(kinds, weights=[self.pools[k]["weight"] for k in kinds])[0]
+            pool = self.pools[kind]
+            if pool["seen"] and (not pool["fresh"] or self.rng.random() < self.repeat_ratio):
+                return kind, self.rng.choice(pool["seen"])
+            path = pool["fresh"].pop()
+            pool["seen"].append(path)
+            return kind, path
+
+
+def run_load(base_url, picker, total_requests, concurrency, think_time, seed):
+    results = []
+    results_lock = threading.Lock()
+    remaining = [total_requests]
+
+    def client(client_id):
+        rng = random.Random(seed + client_id)
+        while True:
+            with results_lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            kind, path = picker.next()
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=60) as resp:
+                    size = len(resp.read())
+                    status = resp.status
+            except urllib.error.HTTPError as e:
+                size, status = len(e.read()), e.code
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                size, status = 0, 0
+            elapsed = time.perf_counter() - start
+            with results_lock:
+                results.append((kind, status, elapsed, size))
+            if think_time > 0:
+                time.sleep(rng.expovariate(1 / think_time))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall_time):
+    def latency_stats(latencies):
+        if not latencies:
+            return {}
+        ms = np.asarray(latencies) * 1000
+        return {
+            "p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(ms, 95)), 2),
+            "p99_ms": round(float(np.percentile(ms, 99)), 2),
+            "mean_ms": round(float(ms.mean()), 2),
+            "max_ms": round(float(ms.max()), 2),
+        }
+
+    statuses = {}
+    for _, status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(1 for _, status, _, _ in results if not 200 <= status < 400)
+
+    report = {
+        "requests": len(results),
+        "wall_time_s": round(wall_time, 3),
+        "throughput_rps": round(len(results) / wall_time, 2) if wall_time else 0,
+        "error_rate": round(errors / len(results), 4) if results else 0,
+        "bytes_transferred": sum(size for _, _, _, size in results),
+        "status_counts": statuses,
+        "latency": latency_stats([elapsed for _, _, elapsed, _ in results]),
+        "latency_by_kind": {},
+    }
+    for kind in sorted({kind for kind, _, _, _ in results}):
+        report["latency_by_kind"][kind] = latency_stats([elapsed for k, _, elapsed, _ in results if k == kind])
+    return report
+
+
+def compare(report, baseline):
+    """Relative change of the headline numbers against a stored report."""
+    rows = [("throughput_rps", report["throughput_rps"], baseline.get("throughput_rps"))]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows.append((key, report["latency"].get(key), baseline.get("latency", {}).get(key)))
+    rows.append(("error_rate", report["error_rate"], baseline.get("error_rate")))
+
+    comparison = {}
+    for key, current, previous in rows:
+        entry = {"current": current, "baseline": previous}
+        if current is not None and previous:
+            entry["change"] = round((current - previous) / previous, 4)
+        comparison[key] = entry
+    return comparison
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+
+    paths = load_request_paths(args.jsonl_files)
+    synthetic_dir = None
+    proc = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            if paths:
+                proc, base_url = start_server(args.port, args.server_args)
+                # fall back to synthetic images if the datasets referenced by the files are not on this machine
+                probe = urllib.request.Request(base_url + paths[0].split("?")[0], method="HEAD")
+                try:
+                    urllib.request.urlopen(probe, timeout=60)
+                except urllib.error.HTTPError:
+                    print("Images referenced by the input files are missing, using synthetic images", file=sys.stderr)
+                    proc.terminate()
+                    proc.wait()
+                    proc, paths = None, []
+            if not paths:
+                synthetic_dir = tempfile.mkdtemp(prefix="stitch_benchmark_")
+                names = make_synthetic_images(synthetic_dir, args.synthetic_images, rng)
+                paths = synthetic_request_paths(names, rng)
+                proc, base_url = start_server(args.port, args.server_args, synthetic_dir)
+
+        picker = RequestPicker(paths, mix, args.repeat_ratio, args.thumbnail_width, args.seed)
+        results, wall_time = run_load(base_url, picker, args.requests, args.concurrency, args.think_time, args.seed)
+
+        report = summarize(results, wall_time)
+        report["config"] = {
+            "inputs": args.jsonl_files if synthetic_dir is None else f"synthetic ({args.synthetic_images} images)",
+            "server": args.url or f"local {args.server_args}".strip(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "think_time": args.think_time,
+            "repeat_ratio": args.repeat_ratio,
+            "mix": mix,
+        }
+        try:
+            report["server_cache"] = json.loads(urllib.request.urlopen(f"{base_url}/cache_stats", timeout=10).read())
+        except (urllib.error.URLError, ValueError):
+            pass
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+import os
+import copy
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader, Subset
+from embedding_store import content_hash
+
+# Shared by the [reddit|pexels|lexica]/build_index.py scripts, which add the repository
+# root to sys.path to import it.
+
+MODEL_NAME = "openai/clip-vit-base-patch32"
+
+
+class ImageDataset(Dataset):
+    """Decodes and CLIP-preprocesses one image per item, so that DataLoader workers can do it in parallel."""
+
+    def __init__(self, sources, processor):
+        self.sources = sources
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.sources)
+
+    def load_image(self, i):
+        return Image.open(self.sources[i]).convert("RGB")
+
+    def __getitem__(self, i):
+        image = self.load_image(i)
+        return self.processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+
+class CachedPixels(Dataset):
+    """An ImageDataset (or a Subset of one) as uint8 (3, size, size) crops, before rescaling and
+    normalization; images in the PixelCache are read from it instead of being decoded."""
+
+    def __init__(self, dataset, keys, pixel_cache):
+        self.indices = list(range(len(dataset)))
+        while isinstance(dataset, Subset):
+            self.indices = [dataset.indices[i] for i in self.indices]
+            dataset = dataset.dataset
+        self.dataset = dataset
+        self.keys = keys
+        self.pixel_cache = pixel_cache
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if self.keys[i] in self.pixel_cache:
+            return torch.from_numpy(np.array(self.pixel_cache[self.keys[i]]))
+        image = self.dataset.load_image(self.indices[i])
+        return self.dataset.processor(images=image, do_rescale=False, do_normalize=False, return_tensors="pt")["pixel_values"][0]
+
+
+def normalize_pixels(processor, pixels):
+    """uint8 crops -> the float32 pixel_values the processor returns for the same images."""
+    ip = processor.image_processor
+    mean = torch.tensor(ip.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+    std = torch.tensor(ip.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+    # rescaled in float64 like the processor, so the embeddings match exactly
+    return ((pixels.double() * ip.rescale_factor).float() - mean) / std
+
+
+def image_features(model, pixel_values):
+    """L2-normalized float32 embeddings of a batch of preprocessed images (call under torch.no_grad())."""
+    embedding = model.get_image_features(pixel_values=pixel_values)["pooler_output"]
+    embedding = embedding / embedding.norm(dim=-1, keepdim=True)
+    return embedding.cpu().numpy().astype("float32")
+
+
+def text_features(model, inputs):
+    """L2-normalized float32 embeddings of a batch of tokenized texts (call under torch.no_grad())."""
+    embedding = model.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])["pooler_output"]
+    embedding = embedding / embedding.norm(dim=-1, keepdim=True)
+    return embedding.cpu().numpy().astype("float32")
+
+
+def embed_images(model, dataset, device, batch_size=64, num_workers=4, prefetch_factor=4, cache=None, keys=None, pixel_cache=None):
+    """Embed all items of an ImageDataset in batches; returns L2-normalized float32 rows in dataset order.
+
+    Decoding and preprocessing run in `num_workers` loader processes that keep up to
+    `prefetch_factor` batches each ready while the current batch runs through the model.
+
+    With an EmbeddingCache and one content hash per item in `keys`, only items that are not
+    cached yet are embedded, and they are checkpointed to the cache every `cache.shard_size` items.
+
+    With a PixelCache (also keyed by `keys`), preprocessed images are read from it, and the
+    images that had to be decoded are added to it.
+    """
+    todo = list(range(len(dataset))) if cache is None else cache.missing(keys)
+    if pixel_cache is not None:
+        dataset = CachedPixels(dataset, keys, pixel_cache)
+    loader = DataLoader(
+        Subset(dataset, todo),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=device == "cuda",
+    )
+
+    embeddings = []  # without a cache: all batches, with a cache: the batches not checkpointed yet
+    checkpointed = 0
+
+    def checkpoint():
+        nonlocal embeddings, checkpointed
+        rows = np.concatenate(embeddings)
+        cache.add([keys[i] for i in todo[checkpointed:checkpointed + len(rows)]], rows)
+        checkpointed += len(rows)
+        embeddings = []
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch, pixel_values in enumerate(tqdm(loader, desc="Images", unit="batch")):
+            if pixel_cache is not None:
+                batch_keys = [keys[i] for i in todo[batch * batch_size:batch * batch_size + len(pixel_values)]]
+                pixel_cache.add(batch_keys, pixel_values.numpy())
+                pixel_values = normalize_pixels(dataset.dataset.processor, pixel_values)
+            embeddings.append(image_features(model, pixel_values.to(device)))
+            if cache is not None and sum(len(e) for e in embeddings) >= cache.shard_size:
+                checkpoint()
+    elapsed = time.perf_counter() - start
+
+    if cache is not None:
+        if embeddings:
+            checkpoint()
+        print(f"Embedded {len(todo)} new images in {elapsed:.1f}s ({len(todo) / elapsed:.1f} images/s), {len(dataset) - len(todo)} taken from the cache")
+        return cache.matrix(keys) if len(dataset) else np.zeros((0, model.config.projection_dim), dtype="float32")
+
+    print(f"Embedded {len(dataset)} images in {elapsed:.1f}s ({len(dataset) / elapsed:.1f} images/s)")
+    return np.concatenate(embeddings) if embeddings else np.zeros((0, model.config.projection_dim), dtype="float32")
+
+
+def _collate_items(items):
+    return items
+
+
+def stream_image_embeddings(model, dataset, device, cache, batch_size=64, num_workers=4, prefetch_factor=4, pixel_cache=None, processor=None):
+    """Single pass over a dataset of dicts with the content hash "key" and "pixel_values" of an image.
+
+    Items whose image is already cached carry pixel_values=None. All items are yielded in dataset
+    order, together with whatever else the dataset puts into them, while the new images are embedded
+    in batches and checkpointed to `cache`. Read the embeddings from the cache once the stream is done.
+
+    With a PixelCache, the items carry uint8 crops as in CachedPixels instead; they are added to
+    the pixel cache and normalized with `processor` here.
+    """
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        collate_fn=_collate_items,
+    )
+
+    shard_keys, shard = [], []
+    embedded = 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for items in tqdm(loader, desc="Images", unit="batch"):
+            todo = [item for item in items if item["pixel_values"] is not None]
+            if todo:
+                pixel_values = torch.stack([item["pixel_values"] for item in todo])
+                if pixel_cache is not None:
+                    pixel_cache.add([item["key"] for item in todo], pixel_values.numpy())
+                    pixel_values = normalize_pixels(processor, pixel_values)
+                shard.append(image_features(model, pixel_values.to(device)))
+                shard_keys.extend(item["key"] for item in todo)
+                embedded += len(todo)
+                if len(shard_keys) >= cache.shard_size:
+                    cache.add(shard_keys, np.concatenate(shard))
+                    shard_keys, shard = [], []
+            yield from items
+    if shard_keys:
+        cache.add(shard_keys, np.concatenate(shard))
+
+    elapsed = time.perf_counter() - start
+    print(f"Streamed {len(dataset)} images in {elapsed:.1f}s, embedded {embedded} new ones ({embedded / elapsed:.1f} images/s)")
+
+
+def embed_texts(model, tokenizer, texts, device, batch_size=256, max_length=77, cache=None):
+    """Embed the distinct strings of `texts`; returns {text: L2-normalized float32 embedding}.
+
+    Duplicates are embedded once. All texts are tokenized in one call of the (fast)
+    tokenizer, and batches are formed from texts of similar token length so that
+    padding stays minimal. With an EmbeddingCache (keyed by the hash of the text), only
+    texts that are not cached yet are embedded, checkpointed every `cache.shard_size` texts.
+    """
+    unique_texts = list(dict.fromkeys(texts))  # keeps first-occurrence order
+    if not unique_texts:
+        return {}
+
+    if cache is not None:
+        keys = [content_hash(text) for text in unique_texts]
+        todo = [unique_texts[i] for i in cache.missing(keys)]
+    else:
+        todo = unique_texts
+
+    embeddings = {}
+    shard = []  # texts embedded but not checkpointed yet
+    start = time.perf_counter()
+    if todo:
+        input_ids = tokenizer(todo, truncation=True, max_length=max_length)["input_ids"]
+        order = np.argsort([len(ids) for ids in input_ids], kind="stable")
+
+        with torch.no_grad():
+            for batch_start in tqdm(range(0, len(order), batch_size), desc="Texts", unit="batch"):
+                batch = order[batch_start:batch_start + batch_size]
+                inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt").to(device)
+                for i, row in zip(batch, text_features(model, inputs)):
+                    embeddings[todo[i]] = row
+                    shard.append(todo[i])
+                if cache is not None and (len(shard) >= cache.shard_size or batch_start + batch_size >= len(order)):
+                    cache.add([content_hash(text) for text in shard], [embeddings[text] for text in shard])
+                    shard = []
+    elapsed = time.perf_counter() - start
+
+    if cache is not None:
+        print(f"Embedded {len(todo)} new texts in {elapsed:.1f}s, {len(unique_texts) - len(todo)} of {len(unique_texts)} unique texts taken from the cache")
+        return {text: cache.embeddings[key] for text, key in zip(unique_texts, keys)}
+
+    print(f"Embedded {len(unique_texts)} unique texts ({len(texts)} in total) in {elapsed:.1f}s ({len(unique_texts) / elapsed:.1f} texts/s)")
+    return {text: embeddings[text] for text in unique_texts}
+
+
+# -----------------------------
+# CPU INFERENCE BACKENDS
+# -----------------------------
+BACKENDS = ("fp32", "int8", "torchscript")
+
+
+class _ImageTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)["pooler_output"]
+
+
+class _TextTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)["pooler_output"]
+
+
+class TracedCLIP:
+    """The two CLIPModel feature methods used by embed_images/embed_texts as frozen TorchScript graphs.
+
+    Batch size and text length stay dynamic; the check_*_backend functions verify the result.
+    """
+
+    def __init__(self, model):
+        self.config = model.config
+        image_size = model.config.vision_config.image_size
+        example_ids = torch.ones((2, 8), dtype=torch.long)
+        with torch.no_grad():
+            self.image_tower = torch.jit.freeze(torch.jit.trace(_ImageTower(model).eval(), torch.zeros(2, 3, image_size, image_size), check_trace=False))
+            self.text_tower = torch.jit.freeze(torch.jit.trace(_TextTower(model).eval(), (example_ids, torch.ones_like(example_ids)), check_trace=False))
+
+    def get_image_features(self, pixel_values):
+        return {"pooler_output": self.image_tower(pixel_values)}
+
+    def get_text_features(self, input_ids, attention_mask):
+        return {"pooler_output": self.text_tower(input_ids, attention_mask)}
+
+
+def load_backend(model, backend):
+    """CPU variant of the fp32 `model`: "int8" quantizes the weights of all linear layers
+    dynamically, "torchscript" traces both towers into graphs."""
+    if backend == "fp32":
+        return model
+    if backend == "int8":
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "torchscript":
+        return TracedCLIP(model.eval())
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+
+def _sample(n, sample_size):
+    return np.unique(np.linspace(0, n - 1, min(n, sample_size)).astype(np.int64)).tolist()
+
+
+def _agreement(reference, candidate, reference_seconds, candidate_seconds):
+    cosine = (reference * candidate).sum(axis=1)  # rows are L2-normalized
+
+    def nearest(embeddings):
+        similarities = embeddings @ embeddings.T
+        np.fill_diagonal(similarities, -np.inf)
+        return similarities.argmax(axis=1)
+
+    return {
+        "sample": len(reference),
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        # nearest other sample item, as used for the Doccano distractors
+        "top1_agreement": float((nearest(reference) == nearest(candidate)).mean()) if len(reference) > 1 else 1.0,
+        "speedup": reference_seconds / max(candidate_seconds, 1e-9),
+    }
+
+
+def check_image_backend(reference, candidate, dataset, sample_size=256, batch_size=64):
+    """Embed an evenly spaced sample of `dataset` with both models and compare the embeddings."""
+    sample = Subset(dataset, _sample(len(dataset), sample_size))
+    start = time.perf_counter()
+    reference_embeddings = embed_images(reference, sample, "cpu", batch_size, num_workers=0)
+    middle = time.perf_counter()
+    candidate_embeddings = embed_images(candidate, sample, "cpu", batch_size, num_workers=0)
+    return _agreement(reference_embeddings, candidate_embeddings, middle - start, time.perf_counter() - middle)
+
+
+def check_text_backend(reference, candidate, tokenizer, texts, sample_size=256, batch_size=256, max_length=77):
+    unique_texts = list(dict.fromkeys(texts))
+    sample = [unique_texts[i] for i in _sample(len(unique_texts), sample_size)]
+    start = time.perf_counter()
+    reference_embeddings = embed_texts(reference, tokenizer, sample, "cpu", batch_size, max_length)
+    middle = time.perf_counter()
+    candidate_embeddings = embed_texts(candidate, tokenizer, sample, "cpu", batch_size, max_length)
+    end = time.perf_counter()
+    return _agreement(np.stack([reference_embeddings[t] for t in sample]), np.stack([candidate_embeddings[t] for t in sample]), middle - start, end - middle)
+
+
+def accept_backend(backend, agreement, min_cosine, min_top1, what):
+    """Print the agreement of `backend` with fp32 and whether it is good enough to embed `what`."""
+    accepted = agreement["cosine_min"] >= min_cosine and agreement["top1_agreement"] >= min_top1
+    print(
+        f"{backend} vs fp32 on {agreement['sample']} {what}: cosine mean {agreement['cosine_mean']:.4f} / min {agreement['cosine_min']:.4f}, "
+        f"top-1 neighbour agreement {agreement['top1_agreement']:.1%}, {agreement['speedup']:.1f}x faster -> "
+        + (f"using {backend}" if accepted else f"below the thresholds ({min_cosine}, {min_top1:.0%}), using fp32")
+    )
+    return accepted
+
+# -----------------------------
+# MULTI-PROCESS EMBEDDING (CPU)
+# -----------------------------
+# State handed to the forked shard workers; forking shares the loaded model and the data
+# copy-on-write instead of pickling them. A process that has run torch ops with more than one
+# OpenMP thread cannot be forked safely (the children hang in their first parallel op), so the
+# calling script has to switch to torch.set_num_threads(1) before it loads the model.
+_shard_state = None
+
+
+def _init_shard_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def _embed_shard(indices, batch_size):
+    model, data, keys, tokenizer, cache, max_length, pixel_cache = _shard_state
+    start = time.perf_counter()
+    if tokenizer is None:
+        if pixel_cache is not None:
+            pixel_cache.writable = False  # the workers would append to the same files
+        embed_images(model, Subset(data, indices), "cpu", batch_size, num_workers=0, cache=cache, keys=[keys[i] for i in indices], pixel_cache=pixel_cache)
+    else:
+        embed_texts(model, tokenizer, [data[i] for i in indices], "cpu", batch_size, max_length, cache=cache)
+    return len(indices), time.perf_counter() - start
+
+
+def _run_shards(todo, processes, threads, batch_size):
+    """Embed the items `todo` in `processes` forked workers with `threads` torch threads each.
+
+    Every worker gets one contiguous slice and checkpoints its embeddings to the shared cache.
+    """
+    if torch.get_num_threads() > 1:
+        raise RuntimeError("Call torch.set_num_threads(1) before loading the model when embedding with several processes")
+    threads = threads or max(1, (os.cpu_count() or 1) // processes)
+    slices = [s.tolist() for s in np.array_split(np.asarray(todo, dtype=np.int64), processes) if len(s)]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=len(slices), mp_context=multiprocessing.get_context("fork"),
+                             initializer=_init_shard_worker, initargs=(threads,)) as pool:
+        for count, seconds in pool.map(_embed_shard, slices, [batch_size] * len(slices)):
+            print(f"Shard of {count} items done in {seconds:.1f}s")
+    return time.perf_counter() - start
+
+
+def embed_images_parallel(model, dataset, keys, cache, processes, threads=None, batch_size=64, pixel_cache=None):
+    """CPU-only variant of embed_images that splits the uncached items over `processes` worker processes.
+
+    Each worker decodes, preprocesses and embeds its slice with `threads` torch threads
+    (default: cores // processes) and writes its own cache shards. The result is read back
+    from the cache in dataset order, so it does not depend on which worker finished first.
+    The workers read from `pixel_cache` but do not add to it; fill it with a single-process run.
+    """
+    global _shard_state
+    todo = cache.missing(keys)
+    _shard_state = (model, dataset, keys, None, cache, None, pixel_cache)
+    try:
+        elapsed = _run_shards(todo, processes, threads, batch_size) if todo else 0.0
+    finally:
+        _shard_state = None
+    cache.reload()
+
+    print(f"Embedded {len(todo)} new images with {processes} processes in {elapsed:.1f}s ({len(todo) / max(elapsed, 1e-9):.1f} images/s), {len(dataset) - len(todo)} taken from the cache")
+    return cache.matrix(keys) if len(dataset) else np.zeros((0, model.config.projection_dim), dtype="float32")
+
+
+def embed_texts_parallel(model, tokenizer, texts, cache, processes, threads=None, batch_size=256, max_length=77):
+    """CPU-only variant of embed_texts with the same sharding as embed_images_parallel."""
+    global _shard_state
+    unique_texts = list(dict.fromkeys(texts))
+    keys = [content_hash(text) for text in unique_texts]
+    todo = cache.missing(keys)
+    _shard_state = (model, unique_texts, keys, tokenizer, cache, max_length, None)
+    try:
+        elapsed = _run_shards(todo, processes, threads, batch_size) if todo else 0.0
+    finally:
+        _shard_state = None
+    cache.reload()
+
+    print(f"Embedded {len(todo)} new texts with {processes} processes in {elapsed:.1f}s, {len(unique_texts) - len(todo)} of {len(unique_texts)} unique texts taken from the cache")
+    return {text: cache.embeddings[key] for text, key in zip(unique_texts, keys)}
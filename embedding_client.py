@@ -0,0 +1,116 @@
+import io
+import sys
+import json
+import argparse
+import urllib.request
+import urllib.error
+import faiss
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPProcessor, CLIPModel, AutoTokenizer
+
+from clip_embedding import MODEL_NAME, image_features, text_features
+from embedding_store import EmbeddingStore
+
+# Client for embedding_server.py. get_embedder() returns a client for a running server with the
+# requested model, or an in-process embedder that loads the model on first use, e.g.
+#   embedder = get_embedder()
+#   query = embedder.embed_texts(["a cat wearing a hat"])  # (1, d) float32, L2-normalized
+
+DEFAULT_URL = "http://127.0.0.1:8091"
+
+
+class EmbeddingClient:
+    def __init__(self, url=DEFAULT_URL, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self):
+        with urllib.request.urlopen(f"{self.url}/health", timeout=2) as resp:
+            return json.loads(resp.read())
+
+    def _post_json(self, route, payload):
+        req = urllib.request.Request(f"{self.url}{route}", data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return np.load(io.BytesIO(resp.read()))
+
+    def embed_texts(self, texts):
+        return self._post_json("/embed/text", {"texts": list(texts)})
+
+    def embed_images(self, paths):
+        """Embed local image files (the server reads them itself)."""
+        return self._post_json("/embed/image", {"paths": [str(p) for p in paths]})
+
+
+class LocalEmbedder:
+    """Same interface as EmbeddingClient, with the model loaded into this process on first use."""
+
+    def __init__(self, model_name=MODEL_NAME, device=None, batch_size=64):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.model = None
+
+    def _load(self):
+        if self.model is None:
+            self.device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+            self.model = CLIPModel.from_pretrained(self.model_name).to(self.device).eval()
+            self.processor = CLIPProcessor.from_pretrained(self.model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+
+    def embed_texts(self, texts):
+        self._load()
+        texts = list(texts)
+        embeddings = [np.zeros((0, self.model.config.projection_dim), dtype="float32")]
+        with torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                inputs = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True, max_length=77, return_tensors="pt")
+                embeddings.append(text_features(self.model, inputs.to(self.device)))
+        return np.concatenate(embeddings)
+
+    def embed_images(self, paths):
+        self._load()
+        paths = list(paths)
+        embeddings = [np.zeros((0, self.model.config.projection_dim), dtype="float32")]
+        with torch.no_grad():
+            for start in range(0, len(paths), self.batch_size):
+                images = [Image.open(p).convert("RGB") for p in paths[start:start + self.batch_size]]
+                pixel_values = self.processor(images=images, return_tensors="pt")["pixel_values"]
+                embeddings.append(image_features(self.model, pixel_values.to(self.device)))
+        return np.concatenate(embeddings)
+
+
+def get_embedder(url=DEFAULT_URL, model_name=MODEL_NAME):
+    """EmbeddingClient if a server with `model_name` answers at `url`, else a LocalEmbedder."""
+    client = EmbeddingClient(url)
+    try:
+        model = client.health()["model"]
+    except (urllib.error.URLError, ConnectionError, TimeoutError, ValueError, KeyError):
+        print(f"No embedding server at {url}, loading {model_name} in-process", file=sys.stderr)
+        return LocalEmbedder(model_name)
+    if model != model_name:
+        print(f"Embedding server at {url} runs {model}, not {model_name}; loading {model_name} in-process", file=sys.stderr)
+        return LocalEmbedder(model_name)
+    return client
+
+
+if __name__ == "__main__":
+    # ad-hoc text-to-image query, e.g. from a dataset directory:
+    #   python ../embedding_client.py "a cat wearing a hat" --k 5
+    parser = argparse.ArgumentParser(description="Find the images closest to a text query")
+    parser.add_argument("query")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--index", default="faiss_image_index.index")
+    parser.add_argument("--ids", default="image_embeddings", help="Embedding store whose keys are the index rows")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--model", default=MODEL_NAME)
+    args = parser.parse_args()
+
+    query = get_embedder(args.url, args.model).embed_texts([args.query])
+    distances, neighbors = faiss.read_index(args.index).search(query, args.k)
+    image_ids = EmbeddingStore(args.ids).keys
+    for distance, row in zip(distances[0], neighbors[0]):
+        if row >= 0:
+            print(f"{distance:.4f}\t{image_ids[row]}")
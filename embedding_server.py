@@ -0,0 +1,183 @@
+import os
+import io
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+import numpy as np
+import torch
+from flask import Flask, request, jsonify, send_file, abort
+from PIL import Image, UnidentifiedImageError
+from transformers import CLIPProcessor, CLIPModel, AutoTokenizer
+
+from clip_embedding import MODEL_NAME, image_features, text_features
+
+# Long-running CLIP embedding service for ad-hoc queries and scripts that need a few fresh
+# embeddings; see embedding_client.py. The model stays loaded, and concurrent requests are
+# merged into micro-batches.
+
+PORT = 8091
+MAX_BATCH_SIZE = 64  # texts or images per forward pass
+MAX_WAIT_MS = 5  # how long the first request of a batch waits for others to join
+MAX_TEXTS_PER_REQUEST = 4096
+MAX_IMAGES_PER_REQUEST = 256
+MAX_LENGTH = 77
+
+app = Flask(__name__)
+service = None
+
+
+class MicroBatcher:
+    """Runs `embed_batch` on batches of the items submitted by concurrent request threads.
+
+    A batch is started as soon as MAX_BATCH_SIZE items are waiting or the oldest waiting
+    item has waited `max_wait` seconds, so a single request is not delayed by more than that.
+    """
+
+    def __init__(self, embed_batch, max_batch_size, max_wait):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items):
+        """Embed `items`; blocks until all of them have been through the model."""
+        futures = []
+        for item in items:
+            future = Future()
+            self.queue.put((item, future))
+            futures.append(future)
+        return np.stack([future.result() for future in futures])
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                embeddings = self.embed_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+            "waiting": self.queue.qsize(),
+        }
+
+
+class EmbeddingService:
+    def __init__(self, model_name, device, max_batch_size, max_wait):
+        start = time.perf_counter()
+        self.model_name = model_name
+        self.device = device
+        self.model = CLIPModel.from_pretrained(model_name).to(device).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.texts = MicroBatcher(self._embed_texts, max_batch_size, max_wait)
+        self.images = MicroBatcher(self._embed_images, max_batch_size, max_wait)
+        print(f"Loaded {model_name} on {device} in {time.perf_counter() - start:.1f}s")
+
+    def _embed_texts(self, texts):
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            return text_features(self.model, inputs)
+
+    def _embed_images(self, pixel_values):
+        with torch.no_grad():
+            return image_features(self.model, torch.stack(pixel_values).to(self.device))
+
+    def preprocess(self, image):
+        # runs in the request thread, so decoding is spread over the concurrent requests
+        return self.processor(images=image.convert("RGB"), return_tensors="pt")["pixel_values"][0]
+
+
+def npy_response(embeddings):
+    buffer = io.BytesIO()
+    np.save(buffer, embeddings.astype("float32", copy=False))
+    buffer.seek(0)
+    return send_file(buffer, mimetype="application/octet-stream")
+
+
+@app.route("/health")
+def health():
+    return jsonify({
+        "model": service.model_name,
+        "device": service.device,
+        "text_batches": service.texts.stats(),
+        "image_batches": service.images.stats(),
+    })
+
+
+@app.route("/embed/text", methods=["POST"])
+def embed_text():
+    """JSON {"texts": [...]} -> float32 .npy array with one L2-normalized row per text."""
+    payload = request.get_json(silent=True) or {}
+    texts = payload.get("texts")
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        abort(400, description='Expected JSON {"texts": [str, ...]}')
+    if len(texts) > MAX_TEXTS_PER_REQUEST:
+        abort(413, description=f"At most {MAX_TEXTS_PER_REQUEST} texts per request")
+    if not texts:
+        return npy_response(np.zeros((0, service.model.config.projection_dim), dtype="float32"))
+    return npy_response(service.texts.submit(texts))
+
+
+@app.route("/embed/image", methods=["POST"])
+def embed_image():
+    """Uploaded files (multipart field "images") or JSON {"paths": [...]} of local files -> float32 .npy array."""
+    images = []
+    try:
+        if request.files:
+            uploads = request.files.getlist("images")
+            if len(uploads) > MAX_IMAGES_PER_REQUEST:
+                abort(413, description=f"At most {MAX_IMAGES_PER_REQUEST} images per request")
+            for upload in uploads:
+                images.append(Image.open(upload.stream))
+        else:
+            paths = (request.get_json(silent=True) or {}).get("paths")
+            if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                abort(400, description='Expected multipart field "images" or JSON {"paths": [str, ...]}')
+            if len(paths) > MAX_IMAGES_PER_REQUEST:
+                abort(413, description=f"At most {MAX_IMAGES_PER_REQUEST} images per request")
+            for path in paths:
+                if not os.path.isfile(path):
+                    abort(404, description=f"No such file: {path}")
+                images.append(Image.open(path))
+        pixel_values = [service.preprocess(image) for image in images]
+    except (UnidentifiedImageError, OSError) as e:
+        abort(400, description=f"Cannot read image: {e}")
+    if not pixel_values:
+        return npy_response(np.zeros((0, service.model.config.projection_dim), dtype="float32"))
+    return npy_response(service.images.submit(pixel_values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve CLIP text and image embeddings on localhost")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    service = EmbeddingService(args.model, args.device, args.max_batch_size, args.max_wait_ms / 1000)
+    # localhost only: the service reads any file path it is given
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# On-disk embedding store shared by the build_index.py and generate_doccano_*.py scripts.
+#
+# A store with prefix `image_embeddings` consists of
+#   image_embeddings.npy         (N, d) float32 or float16 matrix, memory-mapped on load
+#   image_embeddings_ids.json    list of the N keys (image ids or texts), row order
+#   image_embeddings_lookup.npy  (N, 2) uint64 array of (key hash, row), sorted by hash
+# so that a key can be resolved to its row without loading the key table.
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def store_files(prefix):
+    return f"{prefix}.npy", f"{prefix}_ids.json", f"{prefix}_lookup.npy"
+
+
+def save_embeddings(prefix, keys, matrix, dtype="float32"):
+    """Write `matrix` (row i belongs to keys[i]) as an embedding store."""
+    keys = list(keys)
+    matrix = np.asarray(matrix)
+    if matrix.shape[0] != len(keys):
+        raise ValueError(f"{len(keys)} keys for {matrix.shape[0]} embeddings")
+
+    hashes = np.fromiter((key_hash(k) for k in keys), dtype=np.uint64, count=len(keys))
+    order = np.argsort(hashes, kind="stable")
+    lookup = np.stack([hashes[order], order.astype(np.uint64)], axis=1)
+    if len(keys) > 1 and np.any(lookup[1:, 0] == lookup[:-1, 0]):
+        raise ValueError("Duplicate keys (or a 64-bit hash collision) in embedding store")
+
+    matrix_file, ids_file, lookup_file = store_files(prefix)
+    np.save(matrix_file, matrix.astype(dtype, copy=False))
+    with open(ids_file, "w", encoding="utf-8") as f:
+        json.dump(keys, f, ensure_ascii=False)
+    np.save(lookup_file, lookup)
+
+
+class EmbeddingStore:
+    """Read-only, memory-mapped view of an embedding store."""
+
+    def __init__(self, prefix):
+        matrix_file, self._ids_file, lookup_file = store_files(prefix)
+        self.matrix = np.load(matrix_file, mmap_mode="r")
+        self._lookup = np.load(lookup_file, mmap_mode="r")
+        self._keys = None
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def keys(self):
+        """Keys in row order (loaded on first access)."""
+        if self._keys is None:
+            with open(self._ids_file, "r", encoding="utf-8") as f:
+                self._keys = json.load(f)
+        return self._keys
+
+    def row(self, key):
+        """Row of `key`, or None if the key is not in the store."""
+        h = np.uint64(key_hash(key))
+        i = np.searchsorted(self._lookup[:, 0], h)
+        if i < len(self._lookup) and self._lookup[i, 0] == h:
+            return int(self._lookup[i, 1])
+        return None
+
+    def rows(self, keys):
+        """Rows of `keys` as an int64 array; raises KeyError for the first key that is not in the store."""
+        hashes = np.fromiter((key_hash(k) for k in keys), dtype=np.uint64)
+        i = np.minimum(np.searchsorted(self._lookup[:, 0], hashes), len(self._lookup) - 1)
+        found = self._lookup[i, 0] == hashes if len(self._lookup) else np.zeros(len(hashes), dtype=bool)
+        if not found.all():
+            raise KeyError(list(keys)[int(np.argmin(found))])
+        return self._lookup[i, 1].astype(np.int64)
+
+    def __contains__(self, key):
+        return self.row(key) is not None
+
+    def __getitem__(self, key):
+        row = self.row(key)
+        if row is None:
+            raise KeyError(key)
+        return np.asarray(self.matrix[row], dtype="float32")
+
+    def float32_matrix(self):
+        """The matrix as float32 for FAISS; zero-copy unless the store holds float16."""
+        return np.ascontiguousarray(self.matrix, dtype="float32")
+
+
+def content_hash(data):
+    """Hex digest identifying image bytes or a text, independent of file names and row order."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_files(paths, workers=8, memo_file=None):
+    """content hashes of `paths` in order, reading several files at once
+
+    With `memo_file`, hashes are remembered per path together with size and mtime, and files
+    that did not change since are not read again.
+    """
+    memo = {}
+    if memo_file is not None and os.path.exists(memo_file):
+        with open(memo_file, "r", encoding="utf-8") as f:
+            memo = json.load(f)
+
+    def cached_hash(path):
+        st = os.stat(path)
+        entry = memo.get(os.path.abspath(path))
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2], None
+        return file_hash(path), [st.st_size, st.st_mtime_ns]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(cached_hash, paths, chunksize=64))
+
+    if memo_file is not None and any(stat is not None for _, stat in results):
+        for path, (digest, stat) in zip(paths, results):
+            if stat is not None:
+                memo[os.path.abspath(path)] = stat + [digest]
+        os.makedirs(os.path.dirname(memo_file) or ".", exist_ok=True)
+        tmp_path = f"{memo_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_file)
+    return [digest for digest, _ in results]
+
+
+class EmbeddingCache:
+    """Embeddings checkpointed in shards under <cache_dir>/<model name>[@backend]/<kind>/, keyed by content hash.
+
+    Every shard_*.npz holds the content hashes and embeddings of one batch of newly embedded items
+    and is written atomically, so after a crash all completed shards are reused. Switching the model
+    switches the directory, so embeddings of different models are never mixed.
+    """
+
+    def __init__(self, cache_dir, model_name, kind, shard_size=4096, backend="fp32"):
+        # embeddings of the int8/TorchScript backends are close to, but not the same as fp32 ones
+        model_dir = model_name.replace("/", "__") + ("" if backend == "fp32" else f"@{backend}")
+        self.dir = os.path.join(cache_dir, model_dir, kind)
+        self.shard_size = shard_size
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.embeddings = {}
+        self.loaded_shards = set()
+        self.reload()
+        print(f"Loaded {len(self.embeddings)} cached embeddings from {len(self.loaded_shards)} shard(s) in {self.dir}")
+
+    def reload(self):
+        """Load shards written since the last call, e.g. by worker processes."""
+        shard_files = sorted(f for f in os.listdir(self.dir) if f.startswith("shard_") and f.endswith(".npz"))
+        for shard_file in shard_files:
+            if shard_file not in self.loaded_shards:
+                with np.load(os.path.join(self.dir, shard_file)) as shard:
+                    self.embeddings.update(zip(shard["keys"].tolist(), shard["embeddings"]))
+                self.loaded_shards.add(shard_file)
+
+    def __contains__(self, key):
+        return key in self.embeddings
+
+    def missing(self, keys):
+        """Indices of the first occurrence of each key in `keys` that is not cached yet."""
+        seen = set()
+        todo = []
+        for i, key in enumerate(keys):
+            if key not in self.embeddings and key not in seen:
+                seen.add(key)
+                todo.append(i)
+        return todo
+
+    def add(self, keys, embeddings):
+        """Checkpoint one shard of new embeddings."""
+        if not len(keys):
+            return
+        embeddings = np.asarray(embeddings, dtype="float32")
+        # unique per writer, so that several processes can fill the same cache
+        shard_file = f"shard_{time.time_ns()}_{os.getpid()}.npz"
+        shard_path = os.path.join(self.dir, shard_file)
+        tmp_path = f"{shard_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, keys=np.asarray(keys), embeddings=embeddings)
+        os.replace(tmp_path, shard_path)
+        self.loaded_shards.add(shard_file)
+        self.embeddings.update(zip(keys, embeddings))
+
+    def matrix(self, keys):
+        """(len(keys), d) float32 matrix of cached embeddings in the order of `keys`."""
+        return np.stack([self.embeddings[key] for key in keys])
+
+
+class PixelCache:
+    """Preprocessed images (resized and cropped, before normalization) keyed by content hash.
+
+    <prefix>.u8 holds one (3, size, size) uint8 row per image and is memory-mapped for reading,
+    <prefix>_ids.txt holds the content hash of each row, one per line. Both files are only
+    appended to, rows before ids, so a crash leaves at worst rows without an id, which are dropped.
+    """
+
+    def __init__(self, prefix, size=224):
+        self.rows_file = f"{prefix}.u8"
+        self.ids_file = f"{prefix}_ids.txt"
+        self.row_shape = (3, size, size)
+        self.row_bytes = 3 * size * size
+        self.writable = True
+        directory = os.path.dirname(self.rows_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        ids = []
+        if os.path.exists(self.ids_file):
+            with open(self.ids_file, "r", encoding="utf-8") as f:
+                ids = f.read().split()
+        size = os.path.getsize(self.rows_file) if os.path.exists(self.rows_file) else 0
+        keys = ids[:size // self.row_bytes]
+        if size != len(keys) * self.row_bytes:  # rows without ids from an interrupted append
+            with open(self.rows_file, "r+b") as f:
+                f.truncate(len(keys) * self.row_bytes)
+        if len(keys) != len(ids):
+            with open(self.ids_file, "w", encoding="utf-8") as f:
+                f.write("".join(f"{key}\n" for key in keys))
+
+        self.row_of = {key: i for i, key in enumerate(keys)}
+        self._pixels = None
+        print(f"Pixel cache {self.rows_file}: {len(self.row_of)} preprocessed images")
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def __contains__(self, key):
+        return key in self.row_of
+
+    def __getitem__(self, key):
+        row = self.row_of[key]
+        if self._pixels is None or len(self._pixels) <= row:
+            self._pixels = np.memmap(self.rows_file, dtype=np.uint8, mode="r", shape=(len(self.row_of),) + self.row_shape)
+        return self._pixels[row]
+
+    def add(self, keys, rows):
+        """Append uint8 rows of shape (n, 3, size, size); keys that are already cached are skipped."""
+        if not self.writable:
+            return
+        rows = np.asarray(rows, dtype=np.uint8)
+        new, seen = [], set()
+        for i, key in enumerate(keys):
+            if key not in self.row_of and key not in seen:
+                seen.add(key)
+                new.append(i)
+        if not new:
+            return
+        with open(self.rows_file, "ab") as f:
+            f.write(np.ascontiguousarray(rows[new]).tobytes())
+        with open(self.ids_file, "a", encoding="utf-8") as f:
+            f.write("".join(f"{keys[i]}\n" for i in new))
+        for i in new:
+            self.row_of[keys[i]] = len(self.row_of)
+
+
+if __name__ == "__main__":
+    # convert the pickled {key: embedding} dicts of earlier runs, e.g.
+    #   python ../embedding_store.py image_embeddings.pkl text_embeddings.pkl
+    for pkl_path in sys.argv[1:]:
+        with open(pkl_path, "rb") as f:
+            embeddings_dict = pickle.load(f)
+        prefix = os.path.splitext(pkl_path)[0]
+        save_embeddings(prefix, embeddings_dict.keys(), np.stack(list(embeddings_dict.values())))
+        print(f"Converted {pkl_path} ({len(embeddings_dict)} embeddings) to {', '.join(store_files(prefix))}")
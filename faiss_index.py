@@ -0,0 +1,84 @@
+import os
+import re
+import time
+import faiss
+import numpy as np
+
+# Index types for the build_index.py and generate_doccano_*.py scripts, given as faiss.index_factory
+# strings over inner product (the embeddings are L2-normalized, so this is cosine similarity):
+#   "Flat"          exact brute-force search (faiss_*_index.index)
+#   "IVF1024,Flat"  1024 k-means cells, a query visits `nprobe` of them
+#   "IVF1024,PQ64"  as above with vectors compressed to 64 bytes by product quantization
+#   "HNSW32"        graph with 32 links per vector, a query keeps `ef_search` candidates
+# IVF types are trained on a random sample of at most `train_size` vectors; use at least
+# ~40 vectors per cell. benchmark_faiss_index.py compares the types on an embedding store.
+
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+SEARCH_CHUNK_SIZE = 16384  # queries per index.search call in search_rows
+
+
+def index_file(base_file, index_type):
+    """faiss_image_index.index, "IVF1024,PQ64" -> faiss_image_index.ivf1024_pq64.index"""
+    if index_type == "Flat":
+        return base_file
+    root, ext = os.path.splitext(base_file)
+    slug = re.sub(r"[^0-9a-z]+", "_", index_type.lower()).strip("_")
+    return f"{root}.{slug}{ext}"
+
+
+def build_index(matrix, index_type="Flat", train_size=65536, seed=42):
+    """Build an inner-product index of `index_type` over the float32 rows of `matrix`."""
+    index = faiss.index_factory(matrix.shape[1], index_type, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        if len(matrix) > train_size:
+            sample = np.sort(np.random.default_rng(seed).choice(len(matrix), train_size, replace=False))
+            index.train(np.ascontiguousarray(matrix[sample]))
+        else:
+            index.train(matrix)
+    index.add(matrix)
+    return index
+
+
+def set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """Set the search-time accuracy knob of IVF and HNSW indices; other indices are left as they are."""
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+
+
+def write_approx_index(matrix, base_file, index_type, train_size=65536):
+    """Build and save an index of `index_type` next to the flat index `base_file`."""
+    start = time.perf_counter()
+    index = build_index(matrix, index_type, train_size)
+    path = index_file(base_file, index_type)
+    faiss.write_index(index, path)
+    print(f"Saved {index_type} index ({path}) in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def load_index(base_file, index_type="Flat", nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """Read the index of `index_type` saved next to the flat index `base_file`, ready to search."""
+    index = faiss.read_index(index_file(base_file, index_type))
+    set_search_params(index, nprobe, ef_search)
+    return index
+
+
+def search_rows(index, matrix, rows, k, chunk_size=SEARCH_CHUNK_SIZE):
+    """Search `index` with the rows `rows` of `matrix` (e.g. a memory-mapped embedding store) as queries.
+
+    The queries go to FAISS in chunks of `chunk_size`, each one index.search call that FAISS
+    spreads over its OpenMP threads, so only one chunk is copied to float32 at a time.
+    Returns (distances, neighbors) with one row per query, like index.search.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    distances = np.empty((len(rows), k), dtype="float32")
+    neighbors = np.empty((len(rows), k), dtype="int64")
+    for start in range(0, len(rows), chunk_size):
+        queries = np.ascontiguousarray(matrix[rows[start:start + chunk_size]], dtype="float32")
+        distances[start:start + len(queries)], neighbors[start:start + len(queries)] = index.search(queries, k)
+    return distances, neighbors
@@ -0,0 +1,89 @@
+import json
+import numpy as np
+
+from faiss_index import SEARCH_CHUNK_SIZE, search_rows
+
+# Distractor mining for the generate_doccano_*.py scripts. One batched top-k search over all
+# queries (or a lookup in a precomputed knn_table.py table); exclusions (the query's own image,
+# images of the same exclusion group) are applied as numpy masks over the (queries, k) result,
+# and distractors are then picked by rank among the remaining neighbours and/or by a similarity
+# band, e.g.
+#   labels = exclusion_labels(image_ids, load_groups("output/near_duplicate_groups.json"))
+#   negatives = HardNegatives.search(image_index, text_store.matrix, text_rows, k=20, source_rows=image_rows, labels=labels)
+#   hard, _ = negatives.pick(rank=0)                    # closest admissible image
+#   easy, _ = negatives.pick(max_similarity=0.25)       # closest image at most this similar
+# Several picks reuse the same search.
+
+
+def load_groups(path):
+    """JSON list of lists of keys that must not be paired, e.g. output/near_duplicate_groups.json
+    of reddit/remove_duplicates.py."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def exclusion_labels(keys, groups=()):
+    """One int64 label per key (row); keys of the same group share a label, all other keys get their own."""
+    row_of = {key: i for i, key in enumerate(keys)}
+    labels = np.arange(len(keys), dtype=np.int64)
+    for group in groups:
+        rows = [row_of[key] for key in group if key in row_of]
+        if rows:
+            labels[rows] = min(rows)
+    return labels
+
+
+class HardNegatives:
+    """(queries, k) neighbours with similarities, most similar first, with exclusions applied.
+
+    A neighbour is admissible unless it is padding (-1), the query's source row in the index
+    (`source_rows`, None or -1 for none), or shares the source row's label in `labels` (see exclusion_labels).
+    """
+
+    def __init__(self, similarities, neighbors, source_rows=None, labels=None):
+        self.similarities = similarities
+        self.neighbors = neighbors
+        self.admissible = self.neighbors >= 0
+        if source_rows is not None:
+            source_rows = np.array([-1 if row is None else row for row in source_rows], dtype=np.int64)[:, None]
+            self.admissible &= self.neighbors != source_rows
+            if labels is not None:
+                labels = np.asarray(labels)
+                same_group = labels[np.maximum(self.neighbors, 0)] == labels[np.maximum(source_rows, 0)]
+                self.admissible &= ~(same_group & (source_rows >= 0))
+
+    @classmethod
+    def search(cls, index, matrix, query_rows, k, source_rows=None, labels=None, chunk_size=SEARCH_CHUNK_SIZE):
+        """Neighbours of the rows `query_rows` of `matrix` in `index`."""
+        similarities, neighbors = search_rows(index, matrix, query_rows, k, chunk_size)
+        return cls(similarities, neighbors, source_rows, labels)
+
+    @classmethod
+    def from_table(cls, table, query_rows, k, source_rows=None, labels=None):
+        """The first k neighbours of the rows `query_rows` in a knn_table.KnnTable."""
+        query_rows = np.asarray(query_rows, dtype=np.int64)
+        return cls(np.asarray(table.scores[query_rows, :k]), table.neighbors[query_rows, :k].astype(np.int64), source_rows, labels)
+
+    def pick(self, rank=0, min_similarity=None, max_similarity=None):
+        """The `rank`-th admissible neighbour of every query (0: the most similar) among those with a
+        similarity in [min_similarity, max_similarity]; returns (rows, similarities), -1 / nan where
+        the k neighbours hold no such one."""
+        mask = self.admissible.copy()
+        if min_similarity is not None:
+            mask &= self.similarities >= min_similarity
+        if max_similarity is not None:
+            mask &= self.similarities <= max_similarity
+        hit = mask & (np.cumsum(mask, axis=1) == rank + 1)
+        found = hit.any(axis=1)
+        column = hit.argmax(axis=1)
+        queries = np.arange(len(mask))
+        rows = np.where(found, self.neighbors[queries, column], -1)
+        similarities = np.where(found, self.similarities[queries, column], np.nan).astype("float32")
+        return rows, similarities
+
+    def shortfall(self, rows):
+        """Print how many queries got no distractor, i.e. need a larger k or a wider band."""
+        missing = int((rows < 0).sum())
+        if missing:
+            print(f"No admissible distractor among the {self.neighbors.shape[1]} neighbours of {missing} of {len(rows)} queries")
+        return missing
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import imagehash
+from PIL import Image
+from tqdm import tqdm
+
+# Persistent catalog of the images of one dataset, read by the stitch server (sizes and mtimes
+# for its cache keys), the pexels generate_doccano_*.py scripts (file names by id) and
+# reddit/remove_duplicates.py (perceptual hashes) instead of listing, stat-ing or decoding the
+# images themselves. The catalog of <dataset>/images is <dataset>/image_catalog.sqlite, e.g.
+# reddit/output/image_catalog.sqlite. Scripts that change the reddit images update it; for the
+# other datasets run
+#   python image_catalog.py pexels /var/tmp/deckersn/pexels/pexels-110k-768p-min-jpg/images
+# after adding or removing images. An update only decodes new or changed files (size or mtime).
+#
+#   images  one row per file, in directory listing order (`position`), with the dataset id, the
+#           absolute path, byte size, mtime (ns), width, height and phash (hex, as str(imagehash.phash))
+#           or the error if the file could not be decoded (width, height and phash NULL)
+
+CATALOG_FILE = "image_catalog.sqlite"
+BATCH_SIZE = 1024  # files described per commit, so an interrupted build keeps its progress
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    position INTEGER,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    phash TEXT,
+    error TEXT
+);
+"""
+
+
+def image_id(dataset, name):
+    """Dataset id of an image file: <id>_image.jpg (reddit), <slug>-<id>.jpg (pexels), <id>.jpg (lexica)."""
+    if dataset == "reddit":
+        return name.split("_")[0]
+    if dataset == "pexels":
+        return name.split(".")[0].split("-")[-1]
+    return name.split(".")[0]
+
+
+def catalog_path(image_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(image_dir)), CATALOG_FILE)
+
+
+def describe(path):
+    """(width, height, phash, error) of one image file."""
+    try:
+        with Image.open(path) as img:
+            return img.width, img.height, str(imagehash.phash(img)), None
+    except Exception as e:
+        return None, None, None, f"{type(e).__name__}: {e}"
+
+
+def update_catalog(image_dir, dataset, workers=os.cpu_count()):
+    """Bring <image_dir>/../image_catalog.sqlite in line with the files in image_dir.
+
+    Only files that are new or whose size or mtime changed are decoded, by `workers` processes.
+    """
+    path = catalog_path(image_dir)
+    con = sqlite3.connect(path)
+    try:
+        con.executescript(SCHEMA)
+        known = {name: (size, mtime_ns) for name, size, mtime_ns in con.execute("SELECT name, size, mtime_ns FROM images")}
+
+        listed = []
+        todo = []
+        failed = 0
+        with os.scandir(image_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                listed.append(entry.name)
+                if known.get(entry.name) != (st.st_size, st.st_mtime_ns):
+                    todo.append((entry.name, os.path.abspath(entry.path), st.st_size, st.st_mtime_ns))
+        gone = known.keys() - set(listed)
+
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                described = pool.map(describe, [file_path for _, file_path, _, _ in todo], chunksize=16)
+                rows = []
+                for (name, file_path, size, mtime_ns), info in tqdm(zip(todo, described), total=len(todo), desc="Image catalog"):
+                    rows.append((name, image_id(dataset, name), None, file_path, size, mtime_ns) + info)
+                    failed += info[3] is not None
+                    if len(rows) == BATCH_SIZE:
+                        con.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                        con.commit()
+                        rows = []
+                con.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        con.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in gone])
+        con.executemany("UPDATE images SET position = ? WHERE name = ?", enumerate(listed))
+        con.commit()
+    finally:
+        con.close()
+    print(f"Image catalog {path}: {len(listed)} images, {len(todo)} new or changed ({failed} unreadable), {len(gone)} removed")
+
+
+def catalog_is_stale(image_dir):
+    """True if files were added to or removed from image_dir since its catalog was last updated."""
+    path = catalog_path(image_dir)
+    return os.path.exists(path) and os.stat(image_dir).st_mtime_ns > os.stat(path).st_mtime_ns
+
+
+def read_catalog(path):
+    """All rows of a catalog file as dicts, in listing order."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No image catalog {path}, create it with `python image_catalog.py <dataset> <image_dir>`")
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in con.execute("SELECT * FROM images ORDER BY position")]
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or update the image catalog of a dataset")
+    parser.add_argument("dataset", help="reddit, lexica or pexels (determines how ids are parsed from file names)")
+    parser.add_argument("image_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes decoding new or changed images")
+    args = parser.parse_args()
+    update_catalog(args.image_dir, args.dataset, args.workers)
@@ -1,9 +1,22 @@
 import os
-from flask import Flask, send_file, abort
+import argparse
+import time
+from flask import Flask, send_file, abort, jsonify, request, g, Response
+from werkzeug.exceptions import ServiceUnavailable
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
 import numpy as np
 import re
+import hashlib
+import sqlite3
+import threading
+import functools
+import multiprocessing
+from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from image_catalog import catalog_path
 
 
 IMAGE_DIRS = {"reddit": "./reddit/output/images", "lexica": "/var/tmp/deckersn/lexica/images", "pexels": "/var/tmp/deckersn/pexels/pexels-110k-768p-min-jpg/images"}
@@ -15,10 +28,139 @@ BASE_BORDER_RATIO = 0.02
 BASE_SPACING_RATIO = 0.03
 MIN_BORDER_WIDTH = 2
 MIN_SPACING = 5
+REDUCING_GAP = 3.0  # Pillow reducing_gap; 3.0 is practically indistinguishable from a full resample
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # budget for encoded responses kept in memory
+STITCH_CACHE_DIR = "./stitch_cache"  # filled by prerender_stitch_cache.py
+RENDER_WORKERS = os.cpu_count()
+MAX_PENDING_RENDERS = 4 * RENDER_WORKERS  # distinct composites queued or rendering before answering 503
+RETRY_AFTER_SECONDS = 2
+MIN_THUMBNAIL_SIZE = 16  # smallest accepted max_width / max_height query parameter
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+IMAGE_COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 20)
+# take the sizes and mtimes that key the caches from <dataset>/image_catalog.sqlite (see image_catalog.py)
+# instead of stat-ing every source per request; updating the catalog invalidates cached composites
+USE_IMAGE_CATALOG = True
+CATALOG_CHECK_SECONDS = 10  # how often a changed catalog file is picked up
 
 app = Flask(__name__)
 
 
+class StitchCache:
+    """In-memory LRU cache of encoded JPEG responses, bounded by total bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._entries[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+stitch_cache = StitchCache(CACHE_MAX_BYTES)
+
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> (buckets, bucket counts, sum, count)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._types[name] = "counter"
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types[name] = "histogram"
+            if key not in self._histograms:
+                self._histograms[key] = (buckets, [0] * len(buckets), 0.0, 0)
+            buckets, counts, total, count = self._histograms[key]
+            for i, upper in enumerate(buckets):
+                if value <= upper:
+                    counts[i] += 1
+            self._histograms[key] = (buckets, counts, total + value, count + 1)
+
+    def render(self):
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            for name, kind in sorted(self._types.items()):
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (n, labels), value in sorted(self._counters.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt(labels)} {value:g}")
+                    continue
+                for (n, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                    if n != name:
+                        continue
+                    for upper, c in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{fmt(labels + (('le', f'{upper:g}'),))} {c}")
+                    lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {total:g}")
+                    lines.append(f"{name}_count{fmt(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the wall time of the block to timings[stage] (a plain dict, so it pickles across processes)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
 
 def solve_new_widths(heights, widths, total_width):
     heights = np.asarray(heights, dtype=float)
@@ -51,128 +193,295 @@ def solve_new_widths(heights, widths, total_width):
     return x.astype(int)
     
 
-def load_font(size):
-    """Try bundled font, then system fonts, fallback to default."""
-    if os.path.exists(FONT_PATH):
+@functools.lru_cache(maxsize=None)
+def font_source():
+    """Try bundled font, then system fonts; None means Pillow's default font. Resolved once per process."""
+    candidates = [FONT_PATH] if os.path.exists(FONT_PATH) else []
+    candidates += ["DejaVuSans.ttf", "arial.ttf"]
+    for candidate in candidates:
         try:
-            font = ImageFont.truetype(FONT_PATH, size)
-            print(f"✅ Using bundled font {FONT_PATH}")
-            return font
+            ImageFont.truetype(candidate, 10)
         except Exception as e:
-            print(f"⚠️ Failed to load bundled font: {e}")
+            if candidate == FONT_PATH:
+                print(f"⚠️ Failed to load bundled font: {e}")
+            continue
+        print(f"✅ Using bundled font {candidate}" if candidate == FONT_PATH else f"✅ Using system {candidate}")
+        return candidate
 
-    # Try system fonts
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", size)
-        print("✅ Using system DejaVuSans.ttf")
-        return font
-    except Exception:
-        try:
-            font = ImageFont.truetype("arial.ttf", size)
-            print("✅ Using system arial.ttf")
-            return font
-        except Exception:
-            print("⚠️ No TTF font found, using default tiny font")
-            return ImageFont.load_default()
+    print("⚠️ No TTF font found, using default tiny font")
+    return None
 
-def stitch_images(image_paths):
-    images = [Image.open(p).convert("RGB") for p in image_paths]
-    n = len(images)
+
+@functools.lru_cache(maxsize=128)
+def load_font(size):
+    source = font_source()
+    if source is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(source, size)
+
+
+_glyph_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def label_glyph(size, text):
+    """Rendered mask of a label and its bounding box relative to the text origin."""
+    font = load_font(size)
+    # FreeType faces are shared between render threads, so rasterize one label at a time
+    with _glyph_lock:
+        bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+        mask = Image.new("L", (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+        ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), text, fill=255, font=font)
+    return mask, bbox
+
+
+def decode_scaled(img, size, timings=None):
+    """Decode an opened (not yet loaded) image directly at `size`.
+
+    For JPEGs, draft() lets libjpeg apply DCT scaling (1/2, 1/4, 1/8) so the source is
+    decoded close to the target size; the remaining resize uses Pillow's reducing path.
+    """
+    timings = {} if timings is None else timings
+    with timed(timings, "decode"):
+        if img.width > size[0] and img.height > size[1]:
+            img.draft("RGB", size)
+        img = img.convert("RGB")
+    if img.size != size:
+        with timed(timings, "resize"):
+            img = img.resize(size, reducing_gap=REDUCING_GAP)
+    return img
+
+
+@dataclass
+class CompositeLayout:
+    """Geometry of a composite, derived from the source dimensions only."""
+    width: int
+    height: int
+    row_height: int
+    boxes: list  # (x, y, w, h) of each pasted image on the canvas
+    border_width: int = 0
+    spacing: int = 0
+    font_size: int = 0
+    label_height: int = 0
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+
+def compute_layout(sizes, max_row_height=None):
+    """Lay out images of the given (width, height) sizes in one labelled row.
+
+    The row is capped at `max_row_height` (default: MAX_HEIGHT for composites, the native
+    size for a single image).
+    """
+    n = len(sizes)
 
     if n == 1:
         # Single image, no border or label
-        img = images[0]
-        stitched = Image.new("RGB", (img.width, img.height), color="white")
-        stitched.paste(img, (0, 0))
-        return stitched
+        w, h = sizes[0]
+        if max_row_height is not None and h > max_row_height:
+            w, h = max(1, int(w * max_row_height / h)), max_row_height
+        return CompositeLayout(width=w, height=h, row_height=h, boxes=[(0, 0, w, h)])
 
     # Step 1: initial scaling to cap height at MAX_HEIGHT
-    base_height = min(MAX_HEIGHT, max(img.height for img in images))
-    scaled_images = []
-    for img in images:
-        scale = base_height / img.height
-        w = max(1, int(img.width * scale))
-        h = max(1, int(img.height * scale))
-        scaled_images.append(img.resize((w, h)))
+    row_cap = MAX_HEIGHT if max_row_height is None else max_row_height
+    base_height = min(row_cap, max(h for _, h in sizes))
+    prelim_widths = []
+    prelim_heights = []
+    for w, h in sizes:
+        scale = base_height / h
+        prelim_widths.append(max(1, int(w * scale)))
+        prelim_heights.append(max(1, int(h * scale)))
 
     # Step 2: preliminary final row height
-    prelim_heights = [img.height for img in scaled_images]
-    prelim_widths = [img.width for img in scaled_images]
     final_row_height = max(prelim_heights)
 
     # Step 3: adaptive sizes based on final row height
     font_size = max(10, int(final_row_height * BASE_FONT_RATIO))
-    font = load_font(font_size)
     border_width = max(MIN_BORDER_WIDTH, int(final_row_height * BASE_BORDER_RATIO))
     spacing = max(MIN_SPACING, int(final_row_height * BASE_SPACING_RATIO))
-    corner_radius = border_width
     label_height = font_size + 10 if n <= 9 else 0
 
     # Step 4: target row width for n:1
     target_width = n * final_row_height
 
     # Step 5: check if total width exceeds target, apply aspect-ratio-weighted scaling
+    widths, heights = prelim_widths, prelim_heights
     total_width = sum(prelim_widths) + 2*border_width*n + spacing*(n-1)
     if total_width > target_width:
-        scaled_widths = solve_new_widths([img.height for img in scaled_images], [img.width for img in scaled_images], target_width)
+        scaled_widths = solve_new_widths(prelim_heights, prelim_widths, target_width)
 
-        # Resize images proportionally to preserve aspect ratios
-        for i, img in enumerate(scaled_images):
-            orig_w, orig_h = img.size
-            new_w = scaled_widths[i]
-            new_h = max(1, int(orig_h * new_w / orig_w))  # preserve aspect ratio
-            scaled_images[i] = img.resize((new_w, new_h))
+        # Shrink proportionally to preserve aspect ratios
+        widths = [max(1, int(new_w)) for new_w in scaled_widths]
+        heights = [max(1, int(h * new_w / w)) for w, h, new_w in zip(prelim_widths, prelim_heights, widths)]
 
-    # Step 6: recompute final canvas size
-    widths = [img.width for img in scaled_images]
+    # Step 6: final canvas size and image boxes
     total_width = sum(widths) + 2*border_width*n + spacing*(n-1)
     final_height = final_row_height + label_height + 2*border_width
 
-    # Step 7: border colors
-    border_colors = ["#0062B1", "#0C797D"] if n == 2 else ["#73D8FF"] * n
+    boxes = []
+    x_offset = 0
+    for w, h in zip(widths, heights):
+        y_offset = (final_height - label_height - 2*border_width - h) // 2
+        boxes.append((x_offset + border_width, y_offset + border_width, w, h))
+        x_offset += w + 2*border_width + spacing
+
+    return CompositeLayout(
+        width=total_width,
+        height=final_height,
+        row_height=final_row_height,
+        boxes=boxes,
+        border_width=border_width,
+        spacing=spacing,
+        font_size=font_size,
+        label_height=label_height,
+    )
 
-    # Step 8: create canvas
-    stitched = Image.new("RGB", (total_width, final_height), color="white")
-    draw = ImageDraw.Draw(stitched)
 
-    # Step 9: paste images with borders and number labels
-    x_offset = 0
-    for idx, img in enumerate(scaled_images):
-        bw = border_width
-        img_w, img_h = img.width, img.height
-        y_offset = (final_height - label_height - 2*bw - img_h) // 2
-
-        # Draw rounded border
-        draw.rounded_rectangle(
-            [x_offset, y_offset, x_offset + img_w + 2*bw - 1, y_offset + img_h + 2*bw - 1],
-            radius=corner_radius,
-            fill=border_colors[idx]
+def fit_layout(sizes, max_width=None, max_height=None):
+    """Like compute_layout, but shrinks the row until the composite fits the given bounds.
+
+    Borders, spacing and labels have minimum sizes, so tiny bounds are met as closely as
+    those minimums allow.
+    """
+    layout = compute_layout(sizes)
+    for _ in range(16):
+        ratio = min(
+            max_width / layout.width if max_width else 1,
+            max_height / layout.height if max_height else 1,
         )
+        if ratio >= 1 or layout.row_height <= 1:
+            break
+        row_height = max(1, min(int(layout.row_height * ratio), layout.row_height - 1))
+        layout = compute_layout(sizes, max_row_height=row_height)
+    return layout
+
+
+def stitch_images(image_paths, max_width=None, max_height=None, timings=None):
+    timings = {} if timings is None else timings
 
-        # Paste image
-        stitched.paste(img, (x_offset + bw, y_offset + bw))
+    # only the headers are read here, pixels are decoded once the layout is known
+    with timed(timings, "layout"):
+        images = [Image.open(p) for p in image_paths]
+        n = len(images)
+        layout = fit_layout([img.size for img in images], max_width, max_height)
 
-        # Draw number label
-        if n <= 9:
-            number = str(idx + 1)
-            bbox = draw.textbbox((0,0), number, font=font)
-            w = bbox[2] - bbox[0]
-            h = bbox[3] - bbox[1]
-            text_x = x_offset + bw + (img_w - w)//2
-            text_y = y_offset + img_h + 2*bw + 2
-            draw.text((text_x, text_y), number, fill="black", font=font)
+    if n == 1:
+        return decode_scaled(images[0], layout.size, timings)
+
+    # Border colors
+    border_colors = ["#0062B1", "#0C797D"] if n == 2 else ["#73D8FF"] * n
 
-        x_offset += img_w + 2*bw + spacing
+    # Create canvas
+    with timed(timings, "draw"):
+        stitched = Image.new("RGB", layout.size, color="white")
+        draw = ImageDraw.Draw(stitched)
+
+    # Paste images with borders and number labels, each resampled once into its box
+    bw = layout.border_width
+    for idx, (img, (x, y, img_w, img_h)) in enumerate(zip(images, layout.boxes)):
+        scaled = decode_scaled(img, (img_w, img_h), timings)
+
+        with timed(timings, "draw"):
+            # Draw rounded border
+            draw.rounded_rectangle(
+                [x - bw, y - bw, x + img_w + bw - 1, y + img_h + bw - 1],
+                radius=bw,
+                fill=border_colors[idx]
+            )
+
+            # Paste image
+            stitched.paste(scaled, (x, y))
+
+            # Draw number label
+            if n <= 9:
+                mask, bbox = label_glyph(layout.font_size, str(idx + 1))
+                w = bbox[2] - bbox[0]
+                text_x = x + (img_w - w)//2
+                text_y = y + img_h + bw + 2
+                stitched.paste("black", (text_x + bbox[0], text_y + bbox[1]), mask)
 
     return stitched
 
 
 
+@app.route("/cache_stats")
+def cache_stats():
+    stats = stitch_cache.stats()
+    if render_pool is not None:
+        stats["render_pool"] = render_pool.stats()
+    return jsonify(stats)
+
+
 # allow only simple, safe filenames like: 234.jpg, sun_003.png, img-12.jpeg, etc.
 SAFE_FILENAME = re.compile(r"^[A-Za-z0-9_.-]+\.(jpg|jpeg|png)$", re.IGNORECASE)
 
-@app.route("/<path:filename>")
-def handle_request(filename):
+class DatasetCatalog:
+    """Size and mtime of every image of one dataset, from its image catalog.
+
+    The catalog is re-read when its file changed, checked at most every `check_interval`
+    seconds. Images missing from it (added since the last update) are looked up with os.stat.
+    """
+
+    def __init__(self, image_dir, check_interval):
+        self.root = os.path.abspath(image_dir)
+        self.path = catalog_path(image_dir)
+        self.check_interval = check_interval
+        self.entries = {}
+        self.catalog_mtime = None
+        self.next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.entries, self.catalog_mtime = {}, None
+            return
+        if mtime == self.catalog_mtime:
+            return
+        con = sqlite3.connect(self.path)
+        try:
+            self.entries = {name: (mtime_ns, size) for name, mtime_ns, size in con.execute("SELECT name, mtime_ns, size FROM images")}
+        finally:
+            con.close()
+        self.catalog_mtime = mtime
+
+    def stat(self, img_name):
+        """(absolute path, mtime_ns, size) of an image, or None if it does not exist."""
+        now = time.monotonic()
+        if now >= self.next_check:
+            with self._lock:
+                if now >= self.next_check:
+                    self._reload()
+                    self.next_check = now + self.check_interval
+
+        path = os.path.join(self.root, img_name)
+        entry = self.entries.get(img_name)
+        if entry is not None:
+            return (path,) + entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return path, st.st_mtime_ns, st.st_size
+
+
+image_catalogs = {}
+image_catalogs_lock = threading.Lock()
+
+
+def dataset_catalog(dataset):
+    catalog = image_catalogs.get(dataset)
+    if catalog is None:
+        with image_catalogs_lock:
+            catalog = image_catalogs.setdefault(dataset, DatasetCatalog(IMAGE_DIRS[dataset], CATALOG_CHECK_SECONDS))
+    return catalog
+
+
+def resolve_image_paths(filename):
+    """Validate a request path and return the source paths and their cache key."""
 
     # overall check: final request must still end in an image extension
     if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
@@ -183,6 +492,7 @@ def handle_request(filename):
         abort(400, "At least one image is required")
 
     image_paths = []
+    cache_key = []
 
     for part in parts:
         try:
@@ -197,6 +507,16 @@ def handle_request(filename):
         if not SAFE_FILENAME.match(img_name):
             abort(400, f"Invalid filename: {img_name}")
 
+        if USE_IMAGE_CATALOG:
+            # the whitelist rules out separators, so the name always stays inside the catalog root
+            entry = dataset_catalog(dataset).stat(img_name)
+            if entry is None:
+                abort(404, f"Missing source image: {os.path.join(IMAGE_DIRS[dataset], img_name)}")
+            image_paths.append(entry[0])
+            # mtime and size invalidate the cached composite when a source changes
+            cache_key.append(entry)
+            continue
+
         # ---- Build candidate path ----
         candidate = os.path.join(IMAGE_DIRS[dataset], img_name)
 
@@ -207,24 +527,286 @@ def handle_request(filename):
         if not candidate.startswith(root + os.sep):
             abort(400, "Path traversal attempt detected")
 
-        if not os.path.exists(candidate):
+        try:
+            st = os.stat(candidate)
+        except OSError:
             abort(404, f"Missing source image: {candidate}")
 
         image_paths.append(candidate)
+        # mtime and size invalidate the cached composite when a source changes
+        cache_key.append((candidate, st.st_mtime_ns, st.st_size))
+
+    return image_paths, tuple(cache_key)
 
-    # --- unchanged stitching logic ---
-    stitched = stitch_images(image_paths)
 
-    buf = BytesIO()
-    stitched.save(buf, format="JPEG")
-    buf.seek(0)
+def cache_digest(cache_key):
+    """Stable hex digest of a cache key, used for file names and ETags."""
+    return hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()
+
+
+def disk_cache_path(cache_key):
+    """File in STITCH_CACHE_DIR holding the composite for this exact key."""
+    digest = cache_digest(cache_key)
+    return os.path.join(STITCH_CACHE_DIR, digest[:2], digest + ".jpg")
+
+
+def parse_thumbnail_size(args):
+    """Read the optional max_width / max_height request parameters."""
+    size = []
+    for name in ("max_width", "max_height"):
+        value = args.get(name)
+        if value is None:
+            size.append(None)
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            abort(400, f"{name} must be an integer")
+        if value < MIN_THUMBNAIL_SIZE:
+            abort(400, f"{name} must be at least {MIN_THUMBNAIL_SIZE}")
+        size.append(value)
+    return tuple(size)
+
+
+def sized_cache_key(cache_key, max_width, max_height):
+    """Extend a cache key so that thumbnails are cached separately from full composites."""
+    if max_width is None and max_height is None:
+        return cache_key
+    return cache_key + (("thumbnail", max_width, max_height),)
+
+
+def render_composite(image_paths, max_width=None, max_height=None):
+    """Stitch and JPEG-encode a composite, returning the bytes and the per-stage timings."""
+    timings = {}
+    stitched = stitch_images(image_paths, max_width, max_height, timings)
+
+    with timed(timings, "encode"):
+        buf = BytesIO()
+        stitched.save(buf, format="JPEG")
+    return buf.getvalue(), timings
+
+
+class RenderPool:
+    """Runs render_composite on a bounded executor.
+
+    Concurrent requests for the same composite share one render (single-flight), and new
+    renders are rejected with 503 once `max_pending` distinct composites are in flight.
+    """
+
+    def __init__(self, executor, max_pending, cache):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.cache = cache
+        self.coalesced = 0
+        self.rejected = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def render(self, cache_key, image_paths, max_width=None, max_height=None):
+        """Return the encoded composite and its stage timings (empty for coalesced requests)."""
+        with self._lock:
+            future = self._inflight.get(cache_key)
+            owner = future is None
+            if not owner:
+                self.coalesced += 1
+            else:
+                if len(self._inflight) >= self.max_pending:
+                    self.rejected += 1
+                    raise ServiceUnavailable("Too many pending renders, try again later", retry_after=RETRY_AFTER_SECONDS)
+                future = self.executor.submit(render_composite, image_paths, max_width, max_height)
+                self._inflight[cache_key] = future
+        if owner:
+            # outside the lock: a future that is already done runs the callback right here
+            future.add_done_callback(lambda f: self._finish(cache_key, f))
+        data, timings = future.result()
+        return data, timings if owner else {}
+
+    def _finish(self, cache_key, future):
+        # fill the cache before dropping the in-flight entry so that no request
+        # arriving in between starts a second render
+        if future.exception() is None:
+            self.cache.put(cache_key, future.result()[0])
+        with self._lock:
+            del self._inflight[cache_key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._inflight),
+                "max_pending": self.max_pending,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+            }
+
+
+render_pool = None  # set up in __main__; without a pool, composites are rendered in the request thread
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if request.endpoint != "handle_request":
+        return response
+
+    elapsed = time.perf_counter() - g.request_start
+    metrics.inc("stitch_requests_total", status=response.status_code)
+    metrics.observe("stitch_request_seconds", elapsed)
+
+    # transfer covers streaming the body to the client, which happens after this hook
+    transfer_start = time.perf_counter()
+    sent = response.content_length or 0
+    recorded = []
+
+    def on_close():
+        if recorded:
+            return
+        recorded.append(True)
+        metrics.observe("stitch_stage_seconds", time.perf_counter() - transfer_start, stage="transfer")
+        metrics.inc("stitch_response_bytes_total", sent)
+
+    response.call_on_close(on_close)
+    body = response.response
+    if response.direct_passthrough and hasattr(body, "close"):
+        # send_file bodies are handed to the WSGI server as-is (its wsgi.file_wrapper, which
+        # may use sendfile) and never pass through response.close(), so hook the body's own close()
+        body_close = body.close
+
+        def close_and_record():
+            body_close()
+            on_close()
+
+        body.close = close_and_record
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    lines = [metrics.render()]
+
+    stats = stitch_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    lines.append("# TYPE stitch_cache_hits_total counter")
+    lines.append(f"stitch_cache_hits_total {stats['hits']}")
+    lines.append("# TYPE stitch_cache_misses_total counter")
+    lines.append(f"stitch_cache_misses_total {stats['misses']}")
+    lines.append("# TYPE stitch_cache_evictions_total counter")
+    lines.append(f"stitch_cache_evictions_total {stats['evictions']}")
+    lines.append("# TYPE stitch_cache_bytes gauge")
+    lines.append(f"stitch_cache_bytes {stats['bytes']}")
+    lines.append("# TYPE stitch_cache_hit_ratio gauge")
+    lines.append(f"stitch_cache_hit_ratio {stats['hits'] / lookups if lookups else 0:g}")
+
+    if render_pool is not None:
+        pool_stats = render_pool.stats()
+        lines.append("# TYPE stitch_render_pending gauge")
+        lines.append(f"stitch_render_pending {pool_stats['pending']}")
+        lines.append("# TYPE stitch_render_coalesced_total counter")
+        lines.append(f"stitch_render_coalesced_total {pool_stats['coalesced']}")
+        lines.append("# TYPE stitch_render_rejected_total counter")
+        lines.append(f"stitch_render_rejected_total {pool_stats['rejected']}")
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+def observe_stages(timings):
+    for stage, seconds in timings.items():
+        metrics.observe("stitch_stage_seconds", seconds, stage=stage)
+
+
+@app.route("/<path:filename>")
+def handle_request(filename):
+    timings = {}
+    with timed(timings, "validate"):
+        image_paths, cache_key = resolve_image_paths(filename)
+        max_width, max_height = parse_thumbnail_size(request.args)
+        cache_key = sized_cache_key(cache_key, max_width, max_height)
+    metrics.observe("stitch_images_per_request", len(image_paths), buckets=IMAGE_COUNT_BUCKETS)
+
+    if len(image_paths) == 1 and max_width is None and max_height is None:
+        observe_stages(timings)
+        metrics.inc("stitch_responses_total", source="file")
+        # the composite of a single image is the file itself: hand it to the WSGI
+        # server's file wrapper (sendfile under e.g. gunicorn; the built-in development
+        # server streams it in chunks instead) and let Werkzeug derive ETag/Last-Modified
+        # from mtime and size and answer conditional requests with 304
+        try:
+            return send_file(
+                image_paths[0],
+                download_name=filename,
+                conditional=True,
+                etag=True,
+                last_modified=cache_key[0][1] / 1e9
+            )
+        except FileNotFoundError:
+            abort(404, f"Missing source image: {image_paths[0]}")
+
+    with timed(timings, "cache"):
+        data = stitch_cache.get(cache_key)
+        source = "memory"
+        if data is None:
+            # pre-rendered composites are keyed on mtimes too, so a hit is never stale
+            try:
+                with open(disk_cache_path(cache_key), "rb") as f:
+                    data = f.read()
+                source = "disk"
+            except OSError:
+                data = None
+
+    if data is None:
+        source = "render"
+        try:
+            if render_pool is not None:
+                data, render_timings = render_pool.render(cache_key, image_paths, max_width, max_height)
+            else:
+                data, render_timings = render_composite(image_paths, max_width, max_height)
+                stitch_cache.put(cache_key, data)
+        except FileNotFoundError as e:
+            # deleted since the catalog was last updated
+            abort(404, f"Missing source image: {e.filename}")
+        timings.update(render_timings)
+    elif source == "disk":
+        stitch_cache.put(cache_key, data)
+
+    observe_stages(timings)
+    metrics.inc("stitch_responses_total", source=source)
 
     return send_file(
-        buf,
+        BytesIO(data),
         mimetype="image/jpeg",
-        download_name=filename
+        download_name=filename,
+        conditional=True,
+        etag=cache_digest(cache_key)
     )
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=PORT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--render-pool", choices=["process", "thread", "inline"], default="process",
+                        help="Where composites are rendered (inline = in the request thread, no admission control)")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help="Size of the render pool")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING_RENDERS,
+                        help="Distinct composites queued or rendering before new ones get 503")
+    parser.add_argument("--image-dir", action="append", default=[], metavar="DATASET=PATH",
+                        help="Override or add an entry of IMAGE_DIRS (can be given multiple times)")
+    parser.add_argument("--no-image-catalog", action="store_true",
+                        help="Stat every source image per request instead of using the image catalogs")
+    args = parser.parse_args()
+
+    for entry in args.image_dir:
+        dataset, path = entry.split("=", 1)
+        IMAGE_DIRS[dataset] = path
+    USE_IMAGE_CATALOG = not args.no_image_catalog
+
+    if args.render_pool == "process":
+        # spawn instead of fork: the workers are started lazily from inside the threaded server
+        executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+        render_pool = RenderPool(executor, args.max_pending, stitch_cache)
+    elif args.render_pool == "thread":
+        render_pool = RenderPool(ThreadPoolExecutor(max_workers=args.workers), args.max_pending, stitch_cache)
+
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
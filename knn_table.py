@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import numpy as np
+
+# Precomputed exact top-k neighbour tables, written by the build_index.py scripts and read by the
+# generate_doccano_*.py scripts (or any analysis) instead of searching a FAISS index.
+#
+# A table with prefix `knn_image_image` consists of
+#   knn_image_image_neighbors.npy  (N, k) int32 rows of the target store, most similar first
+#   knn_image_image_scores.npy     (N, k) float32 inner products (cosine similarities)
+#   knn_image_image.json           the query and target stores and their sizes
+# where row i belongs to row i of the query store. Both arrays are memory-mapped on load, so
+# looking up the neighbours of an item is a single row read.
+
+QUERY_BLOCK = 1024  # query rows per matrix product
+TARGET_BLOCK = 65536  # target rows per matrix product
+
+
+def table_files(prefix):
+    return f"{prefix}_neighbors.npy", f"{prefix}_scores.npy", f"{prefix}.json"
+
+
+def write_knn_table(prefix, query_store, target_store, k, query_block=QUERY_BLOCK, target_block=TARGET_BLOCK):
+    """Top-k targets of every query row by inner product, from blocked matrix products.
+
+    Only a (query_block, target_block) block of similarities is held at a time; the result is
+    written straight into the memory-mapped output arrays. Equal scores are ordered by row.
+    """
+    start = time.perf_counter()
+    queries, targets = query_store.matrix, target_store.matrix
+    k = min(k, len(targets))
+    neighbors_file, scores_file, meta_file = table_files(prefix)
+    neighbors = np.lib.format.open_memmap(neighbors_file, mode="w+", dtype=np.int32, shape=(len(queries), k))
+    scores = np.lib.format.open_memmap(scores_file, mode="w+", dtype=np.float32, shape=(len(queries), k))
+
+    for q_start in range(0, len(queries), query_block):
+        q = np.ascontiguousarray(queries[q_start:q_start + query_block], dtype="float32")
+        best_scores = np.empty((len(q), 0), dtype=np.float32)
+        best_rows = np.empty((len(q), 0), dtype=np.int64)
+        for t_start in range(0, len(targets), target_block):
+            t = np.ascontiguousarray(targets[t_start:t_start + target_block], dtype="float32")
+            block_scores = q @ t.T
+            # top k of the block first, so that only k row ids per query are materialised
+            if len(t) > k:
+                keep = np.argpartition(block_scores, len(t) - k, axis=1)[:, -k:]
+                block_scores = np.take_along_axis(block_scores, keep, axis=1)
+            else:
+                keep = np.broadcast_to(np.arange(len(t)), block_scores.shape)
+            block_scores = np.concatenate([best_scores, block_scores], axis=1)
+            block_rows = np.concatenate([best_rows, keep + t_start], axis=1)
+            if block_scores.shape[1] > k:
+                keep = np.argpartition(-block_scores, k - 1, axis=1)[:, :k]
+                block_scores = np.take_along_axis(block_scores, keep, axis=1)
+                block_rows = np.take_along_axis(block_rows, keep, axis=1)
+            best_scores, best_rows = block_scores, block_rows
+        order = np.lexsort((best_rows, -best_scores), axis=1)
+        scores[q_start:q_start + len(q)] = np.take_along_axis(best_scores, order, axis=1)
+        neighbors[q_start:q_start + len(q)] = np.take_along_axis(best_rows, order, axis=1)
+
+    neighbors.flush()
+    scores.flush()
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump({"queries": len(queries), "targets": len(targets), "k": k}, f)
+    print(f"Saved top-{k} neighbour table ({prefix}) of {len(queries)} x {len(targets)} rows in {time.perf_counter() - start:.1f}s")
+
+
+class KnnTable:
+    """Read-only, memory-mapped view of a neighbour table; table[row] -> (neighbor rows, scores)."""
+
+    def __init__(self, prefix):
+        neighbors_file, scores_file, meta_file = table_files(prefix)
+        self.neighbors = np.load(neighbors_file, mmap_mode="r")
+        self.scores = np.load(scores_file, mmap_mode="r")
+        with open(meta_file, "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.k = self.neighbors.shape[1]
+
+    def __len__(self):
+        return self.neighbors.shape[0]
+
+    def __getitem__(self, row):
+        return self.neighbors[row], self.scores[row]
+
+
+def load_knn_table(prefix, query_prefix, target_prefix, k):
+    """The table `prefix` if it has at least k columns and is newer than both embedding stores, else None."""
+    neighbors_file, _, meta_file = table_files(prefix)
+    if not os.path.exists(meta_file):
+        return None
+    table_time = os.path.getmtime(meta_file)
+    if any(os.path.getmtime(f"{store}.npy") > table_time for store in (query_prefix, target_prefix)):
+        print(f"Neighbour table {prefix} is older than the embeddings, not using it")
+        return None
+    table = KnnTable(prefix)
+    if table.k < k and table.k < table.meta["targets"]:
+        print(f"Neighbour table {prefix} has {table.k} < {k} neighbours per item, not using it")
+        return None
+    return table
@@ -1,14 +1,25 @@
+import io
 import os
+import sys
 import torch
 import faiss
 import numpy as np
-from PIL import Image
-from tqdm import tqdm
-from transformers import CLIPProcessor, CLIPModel
-import pickle
+from transformers import CLIPProcessor, CLIPModel, AutoTokenizer
+import datasets
 from datasets import load_dataset
 import json
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from torch.utils.data import Dataset
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from clip_embedding import MODEL_NAME, ImageDataset, stream_image_embeddings, embed_texts, embed_images_parallel, embed_texts_parallel
+from clip_embedding import load_backend, check_image_backend, check_text_backend, accept_backend
+from faiss_index import write_approx_index
+from knn_table import write_knn_table
+from embedding_store import save_embeddings, EmbeddingStore, EmbeddingCache, PixelCache, content_hash
 
 # -----------------------------
 # CONFIG
@@ -19,97 +30,233 @@ IMAGE_OUT_DIR = "/var/tmp/deckersn/lexica/images"
 IMAGE_INDEX_FILE = "faiss_image_index.index"
 TEXT_INDEX_FILE = "faiss_text_index.index"
 
-IMAGE_EMBEDDINGS_FILE = "image_embeddings.pkl"
-TEXT_EMBEDDINGS_FILE = "text_embeddings.pkl"
+# approximate indices saved next to the flat ones (as e.g. faiss_image_index.hnsw32.index), given as
+# faiss.index_factory strings such as "IVF1024,Flat", "IVF1024,PQ64" or "HNSW32" (see faiss_index.py)
+APPROX_INDEX_TYPES = []
+INDEX_TRAIN_SIZE = 65536  # vectors sampled to train IVF indices
+
+# exact top-KNN_TABLE_K neighbour tables for the generate_doccano_*.py scripts, image -> image and
+# text -> image, computed with blocked matrix products (0: no tables, the scripts search instead)
+KNN_TABLE_K = 32
+IMAGE_KNN_PREFIX = "knn_image_image"
+TEXT_KNN_PREFIX = "knn_text_image"
+
+# embedding stores: <prefix>.npy matrix, <prefix>_ids.json keys, <prefix>_lookup.npy hash -> row
+IMAGE_EMBEDDINGS_PREFIX = "image_embeddings"
+TEXT_EMBEDDINGS_PREFIX = "text_embeddings"
+EMBEDDING_DTYPE = "float32"  # "float16" halves the stores; FAISS still gets float32
+
+# embeddings checkpointed in shards, keyed by image content / text hash and model name, so that
+# reruns only embed new or changed items and interrupted runs resume from the last shard
+EMBEDDING_CACHE_DIR = "embedding_cache"
+CACHE_SHARD_SIZE = 4096
+# keep the preprocessed images (resized and cropped uint8 pixels, ~150 KB each) in one memory-mapped
+# file under EMBEDDING_CACHE_DIR, so that runs that have to re-embed them (new model weights or
+# backend) do not decode the images again
+PIXEL_CACHE = False
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+IMAGE_BATCH_SIZE = 64
+LOADER_WORKERS = min(8, os.cpu_count())  # processes decoding and preprocessing images ahead of the model
+TEXT_BATCH_SIZE = 256
+EXPORT_WRITERS = 4  # threads writing the exported JPEGs
+MAX_PENDING_WRITES = 256  # encoded JPEGs queued for the writers before the stream waits for them
+
+# CPU only: with EMBED_PROCESSES > 1, images and texts are split over that many worker processes
+# with TORCH_THREADS_PER_PROCESS torch threads each (None: cores // EMBED_PROCESSES)
+EMBED_PROCESSES = 1
+TORCH_THREADS_PER_PROCESS = None
+
+# CPU only: "int8" (dynamically quantized linear layers) or "torchscript" (traced graphs) instead of
+# the fp32 model. They are only used for images / texts if their embeddings of a sample agree with fp32.
+BACKEND = "fp32"
+BACKEND_CHECK_SAMPLE = 256
+BACKEND_MIN_COSINE = 0.99  # lowest cosine similarity to the fp32 embedding of the same item
+BACKEND_MIN_TOP1 = 0.95  # share of sample items with the same nearest neighbour as with fp32
+
 # -----------------------------
 # LOAD CLIP MODEL
 # -----------------------------
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(DEVICE)
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+if EMBED_PROCESSES > 1 and DEVICE == "cpu":
+    # the workers are forked from this process, which therefore must not start OpenMP threads itself
+    torch.set_num_threads(1)
+
+model = CLIPModel.from_pretrained(MODEL_NAME).to(DEVICE)
+processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+
+backend_model = load_backend(model, BACKEND) if BACKEND != "fp32" and DEVICE == "cpu" else None
 
 # -----------------------------
-# STEP 1: EMBED IMAGES
+# STEP 1: STREAM THE DATASET ONCE
 # -----------------------------
+# one pass yields the ids and prompts, embeds the images that are not cached yet and exports
+# the JPEGs that are not on disk yet
 print("Embedding images...")
-dataset = load_dataset(DATASET_PATH, split='train')
+dataset = load_dataset(DATASET_PATH, split='train').select_columns(["id", "prompt", "image"])
+dataset = dataset.cast_column("image", datasets.Image(decode=False))  # decoded by the loader workers below
 
 Path(IMAGE_OUT_DIR).mkdir(parents=True, exist_ok=True)
 
-image_embeddings_dict = {}  # id -> embedding
-image_ids = []
-
-for entry in tqdm(dataset, desc="Images"):
-    id_ = entry["id"]
-    image_ids.append(id_)
-
-    image = entry["image"].convert("RGB")
-    
-    image.save(os.path.join(IMAGE_OUT_DIR, id_+".jpg"))
-    
-    inputs = processor(images=image, return_tensors="pt").to(DEVICE)
-    with torch.no_grad():
-        embedding = model.get_image_features(**inputs)["pooler_output"]
-        embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-    image_embeddings_dict[id_] = embedding.cpu().numpy().flatten()  # store as 1D array
-
-# Build FAISS index
-image_embeddings_array = np.stack(list(image_embeddings_dict.values())).astype("float32")
-d = image_embeddings_array.shape[1]
-image_index = faiss.IndexFlatIP(d)
-image_index.add(image_embeddings_array)
-
-# Map index positions to IDs
-image_id_list = list(image_embeddings_dict.keys())
-
-# Save everything
+
+def encoded_image(entry):
+    return entry["image"]["bytes"] or Path(entry["image"]["path"]).read_bytes()
+
+
+class LexicaImages(ImageDataset):
+    """Decodes the images of the dataset (for the backend check and the multi-process mode)."""
+
+    def load_image(self, i):
+        return Image.open(io.BytesIO(encoded_image(self.sources[i]))).convert("RGB")
+
+
+class LexicaRows(Dataset):
+    """Everything the build needs from one dataset row, prepared in a loader worker.
+
+    The image is only decoded if it still has to be embedded (not in `cache`; with
+    `processor` None the embedding happens later) or exported (no JPEG in IMAGE_OUT_DIR).
+    With a PixelCache, images to embed come as uint8 crops, read from it where possible.
+    """
+
+    def __init__(self, rows, processor, cache, pixel_cache=None):
+        self.rows = rows
+        self.processor = processor
+        self.cache = cache
+        self.pixel_cache = pixel_cache
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        entry = self.rows[i]
+        data = encoded_image(entry)
+        item = {
+            "id": entry["id"],
+            "prompt": entry["prompt"],
+            "key": content_hash(data),
+            "jpeg_path": os.path.join(IMAGE_OUT_DIR, entry["id"] + ".jpg"),
+            "jpeg": None,
+            "pixel_values": None,
+        }
+        embed = self.processor is not None and item["key"] not in self.cache
+        if embed and self.pixel_cache is not None and item["key"] in self.pixel_cache:
+            item["pixel_values"] = torch.from_numpy(np.array(self.pixel_cache[item["key"]]))
+            embed = False
+        export = not os.path.exists(item["jpeg_path"])
+        if embed or export:
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+            if export:
+                # encoded here, written by the writer threads of the main process
+                buffer = io.BytesIO()
+                image.save(buffer, format="JPEG")
+                item["jpeg"] = buffer.getvalue()
+            if embed and self.pixel_cache is not None:
+                item["pixel_values"] = self.processor(images=image, do_rescale=False, do_normalize=False, return_tensors="pt")["pixel_values"][0]
+            elif embed:
+                item["pixel_values"] = self.processor(images=image, return_tensors="pt")["pixel_values"][0]
+        return item
+
+
+def write_file(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # a crash never leaves a truncated JPEG that would be skipped next time
+
+
+image_model, image_backend = model, "fp32"
+if backend_model is not None:
+    agreement = check_image_backend(model, backend_model, LexicaImages(dataset, processor), BACKEND_CHECK_SAMPLE, IMAGE_BATCH_SIZE)
+    if accept_backend(BACKEND, agreement, BACKEND_MIN_COSINE, BACKEND_MIN_TOP1, "images"):
+        image_model, image_backend = backend_model, BACKEND
+
+image_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, MODEL_NAME, "images", CACHE_SHARD_SIZE, image_backend)
+crop_size = processor.image_processor.crop_size["height"]
+pixel_cache = PixelCache(os.path.join(EMBEDDING_CACHE_DIR, f"pixels_{crop_size}"), crop_size) if PIXEL_CACHE else None
+parallel = EMBED_PROCESSES > 1 and DEVICE == "cpu"
+
+image_ids, image_hashes, prompts = [], [], []
+pending_writes = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+failed_writes = []  # (JPEG path, exception); a failed write leaves no JPEG, so it is exported again next run
+
+
+def written(future, jpeg_path):
+    pending_writes.release()
+    if future.exception() is not None:
+        failed_writes.append((jpeg_path, future.exception()))
+
+
+submitted = 0
+with ThreadPoolExecutor(max_workers=EXPORT_WRITERS) as writer:
+    rows = LexicaRows(dataset, None if parallel else processor, image_cache, pixel_cache)
+    for item in stream_image_embeddings(image_model, rows, DEVICE, image_cache, IMAGE_BATCH_SIZE, LOADER_WORKERS, pixel_cache=pixel_cache, processor=processor):
+        image_ids.append(item["id"])
+        image_hashes.append(item["key"])
+        prompts.append(item["prompt"])
+        if item["jpeg"] is not None:
+            # blocks while MAX_PENDING_WRITES JPEGs are waiting, so a slow disk cannot pile them up in memory
+            pending_writes.acquire()
+            future = writer.submit(write_file, item["jpeg_path"], item["jpeg"])
+            future.add_done_callback(lambda f, jpeg_path=item["jpeg_path"]: written(f, jpeg_path))
+            submitted += 1
+
+for jpeg_path, e in failed_writes:
+    print(f"Failed to export {jpeg_path}: {e}")
+print(f"Exported {submitted - len(failed_writes)} new JPEGs to {IMAGE_OUT_DIR}, {len(failed_writes)} failed")
+
+if parallel:
+    # the stream only hashed and exported; the worker processes decode the uncached images themselves
+    embed_images_parallel(image_model, LexicaImages(dataset, processor), image_hashes, image_cache, EMBED_PROCESSES, TORCH_THREADS_PER_PROCESS, IMAGE_BATCH_SIZE, pixel_cache)
+embeddings = image_cache.matrix(image_hashes)
+
+# Save the embeddings (row i belongs to image_ids[i]) and build the FAISS index from the mapped matrix
+save_embeddings(IMAGE_EMBEDDINGS_PREFIX, image_ids, embeddings, EMBEDDING_DTYPE)
+image_store = EmbeddingStore(IMAGE_EMBEDDINGS_PREFIX)
+
+image_index = faiss.IndexFlatIP(image_store.matrix.shape[1])
+image_index.add(image_store.float32_matrix())
 faiss.write_index(image_index, IMAGE_INDEX_FILE)
-with open(IMAGE_EMBEDDINGS_FILE, "wb") as f:
-    pickle.dump(image_embeddings_dict, f)
+for index_type in APPROX_INDEX_TYPES:
+    write_approx_index(image_store.float32_matrix(), IMAGE_INDEX_FILE, index_type, INDEX_TRAIN_SIZE)
 
-print(f"Saved image index ({IMAGE_INDEX_FILE}) and embeddings dict ({IMAGE_EMBEDDINGS_FILE})")
+print(f"Saved image index ({IMAGE_INDEX_FILE}) and embeddings ({IMAGE_EMBEDDINGS_PREFIX}.npy)")
+if KNN_TABLE_K:
+    write_knn_table(IMAGE_KNN_PREFIX, image_store, image_store, KNN_TABLE_K)
 
 # -----------------------------
 # STEP 2: EMBED COMMENT TEXTS
 # -----------------------------
 print("Embedding comment texts...")
 
-text_embeddings_dict = {}  # text string -> embedding
-
-for entry in tqdm(dataset, desc="Prompts"):
-
-    prompt = entry["prompt"]
-    
-    inputs = processor(
-        text=prompt,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,   # truncate to model max
-        max_length=77
-    ).to(DEVICE)
-    
-    with torch.no_grad():
-        embedding = model.get_text_features(**inputs)["pooler_output"]
-        embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-    text_embeddings_dict[prompt] = embedding.cpu().numpy().flatten()
+# prompts were collected in the dataset pass of step 1
+
+# text string -> embedding, duplicates embedded once, truncated to the model max of 77 tokens
+text_model, text_backend = model, "fp32"
+if backend_model is not None and prompts:
+    agreement = check_text_backend(model, backend_model, tokenizer, prompts, BACKEND_CHECK_SAMPLE, TEXT_BATCH_SIZE)
+    if accept_backend(BACKEND, agreement, BACKEND_MIN_COSINE, BACKEND_MIN_TOP1, "texts"):
+        text_model, text_backend = backend_model, BACKEND
+
+text_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, MODEL_NAME, "texts", CACHE_SHARD_SIZE, text_backend)
+if EMBED_PROCESSES > 1 and DEVICE == "cpu":
+    text_embeddings_dict = embed_texts_parallel(text_model, tokenizer, prompts, text_cache, EMBED_PROCESSES, TORCH_THREADS_PER_PROCESS, TEXT_BATCH_SIZE)
+else:
+    text_embeddings_dict = embed_texts(text_model, tokenizer, prompts, DEVICE, TEXT_BATCH_SIZE, cache=text_cache)
 
 # Build FAISS index for text
 if text_embeddings_dict:
-    text_embeddings_array = np.stack(list(text_embeddings_dict.values())).astype("float32")
-    d_text = text_embeddings_array.shape[1]
-    text_index = faiss.IndexFlatIP(d_text)
-    text_index.add(text_embeddings_array)
-    
-    # Map index positions to text
-    text_id_list = list(text_embeddings_dict.keys())
-
-    # Save
+    save_embeddings(TEXT_EMBEDDINGS_PREFIX, text_embeddings_dict.keys(), np.stack(list(text_embeddings_dict.values())), EMBEDDING_DTYPE)
+    text_store = EmbeddingStore(TEXT_EMBEDDINGS_PREFIX)
+
+    text_index = faiss.IndexFlatIP(text_store.matrix.shape[1])
+    text_index.add(text_store.float32_matrix())
     faiss.write_index(text_index, TEXT_INDEX_FILE)
-    with open(TEXT_EMBEDDINGS_FILE, "wb") as f:
-        pickle.dump(text_embeddings_dict, f)
+    for index_type in APPROX_INDEX_TYPES:
+        write_approx_index(text_store.float32_matrix(), TEXT_INDEX_FILE, index_type, INDEX_TRAIN_SIZE)
 
-    print(f"Saved text index ({TEXT_INDEX_FILE}) and embeddings dict ({TEXT_EMBEDDINGS_FILE})")
+    print(f"Saved text index ({TEXT_INDEX_FILE}) and embeddings ({TEXT_EMBEDDINGS_PREFIX}.npy)")
+    if KNN_TABLE_K:
+        write_knn_table(TEXT_KNN_PREFIX, text_store, image_store, KNN_TABLE_K)
 else:
     print("No comment texts found. Skipping text index.")
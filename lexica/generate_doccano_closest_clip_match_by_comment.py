@@ -1,12 +1,16 @@
 import os
+import sys
 import json
 import random
-import pickle
-import faiss
-import numpy as np
 from tqdm import tqdm
 from datasets import load_dataset
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from embedding_store import EmbeddingStore
+from faiss_index import load_index
+from knn_table import load_knn_table
+from hard_negatives import HardNegatives, exclusion_labels, load_groups
+
 # -----------------------------
 # CONFIG
 # -----------------------------
@@ -18,61 +22,66 @@ GAMMA_DOMAIN = "http://gammaweb09.medien.uni-weimar.de:8080"
 SEED = 42
 
 IMAGE_INDEX_FILE = "faiss_image_index.index"
-IMAGE_EMBEDDINGS_FILE = "image_embeddings.pkl"
-TEXT_EMBEDDINGS_FILE = "text_embeddings.pkl"
+IMAGE_INDEX_TYPE = "Flat"  # or one of the APPROX_INDEX_TYPES of build_index.py, e.g. "HNSW32"
+NPROBE = 16  # IVF cells visited per query
+EF_SEARCH = 64  # HNSW candidates kept per query
+SEARCH_CHUNK_SIZE = 16384  # prompts searched per FAISS call
+IMAGE_EMBEDDINGS_PREFIX = "image_embeddings"
+TEXT_EMBEDDINGS_PREFIX = "text_embeddings"
+
+# distractor choice (see hard_negatives.py): the NEGATIVE_RANK-th closest admissible image (0: the
+# hardest) with a similarity in [NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY] (None: no bound)
+# among the NEGATIVE_SEARCH_K nearest images of the text; raise NEGATIVE_SEARCH_K along with
+# the rank, a band or exclusion groups
+NEGATIVE_SEARCH_K = 2
+NEGATIVE_RANK = 0
+NEGATIVE_MIN_SIMILARITY = None
+NEGATIVE_MAX_SIMILARITY = None
+EXCLUSION_GROUPS_FILE = None  # JSON list of lists of image ids never paired with each other
+
+# neighbour table precomputed by build_index.py (KNN_TABLE_K); the FAISS index is only loaded and
+# searched without a current table with at least NEGATIVE_SEARCH_K neighbours (None: always search)
+KNN_TABLE_PREFIX = "knn_text_image"
 
 random.seed(SEED)
 
 # -----------------------------
 # LOAD EMBEDDINGS
 # -----------------------------
-with open(IMAGE_EMBEDDINGS_FILE, "rb") as f:
-    image_embeddings_dict = pickle.load(f)
-image_ids = list(image_embeddings_dict.keys())
-image_embeddings_array = np.stack(list(image_embeddings_dict.values())).astype("float32")
-
-with open(TEXT_EMBEDDINGS_FILE, "rb") as f:
-    text_embeddings_dict = pickle.load(f)
-text_ids = list(text_embeddings_dict.keys())
-text_embeddings_array = np.stack(list(text_embeddings_dict.values())).astype("float32")
+image_store = EmbeddingStore(IMAGE_EMBEDDINGS_PREFIX)  # memory-mapped, row i belongs to image_ids[i]
+image_ids = image_store.keys
+text_store = EmbeddingStore(TEXT_EMBEDDINGS_PREFIX)  # texts are resolved to rows by hash, the text table is never loaded
 
 # -----------------------------
-# LOAD FAISS INDICES
+# LOAD NEIGHBOUR TABLE OR IMAGE FAISS INDEX
 # -----------------------------
-image_index = faiss.read_index(IMAGE_INDEX_FILE)
-
-# Build image ID → index position mapping for FAISS results
-image_id_to_idx = {id_: i for i, id_ in enumerate(image_ids)}
+knn_table = load_knn_table(KNN_TABLE_PREFIX, TEXT_EMBEDDINGS_PREFIX, IMAGE_EMBEDDINGS_PREFIX, NEGATIVE_SEARCH_K) if KNN_TABLE_PREFIX else None
+image_index = load_index(IMAGE_INDEX_FILE, IMAGE_INDEX_TYPE, NPROBE, EF_SEARCH) if knn_table is None else None
 
 # -----------------------------
 # GENERATE JSONL
 # -----------------------------
+dataset = load_dataset(DATASET_PATH, split='train')
+items = [(entry["id"], entry["prompt"]) for entry in tqdm(dataset.select_columns(["id", "prompt"]), desc="Prompts")]
+
+# neighbours of all prompts from the table, or one batched search in chunks of SEARCH_CHUNK_SIZE
+query_rows = text_store.rows([prompt for _, prompt in items])
+source_rows = [image_store.row(id_) for id_, _ in items]
+labels = exclusion_labels(image_ids, load_groups(EXCLUSION_GROUPS_FILE)) if EXCLUSION_GROUPS_FILE else None
+if knn_table is not None:
+    negatives = HardNegatives.from_table(knn_table, query_rows, NEGATIVE_SEARCH_K, source_rows, labels)
+else:
+    negatives = HardNegatives.search(image_index, text_store.matrix, query_rows, NEGATIVE_SEARCH_K, source_rows, labels, SEARCH_CHUNK_SIZE)
+nearest, _ = negatives.pick(NEGATIVE_RANK, NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY)
+negatives.shortfall(nearest)
+
 lines = []
 swap_log = {}
 counter = 0
 
-dataset = load_dataset(DATASET_PATH, split='train')
-
-for entry in tqdm(dataset, desc="Prompts"):
-    id_ = entry["id"]
-    prompt = entry["prompt"]
-
-    comment_emb = text_embeddings_dict[prompt].reshape(1, -1).astype("float32")
-
-    # Search nearest image by comment embedding
-    D, I = image_index.search(comment_emb, k=2)  # get top 2 neighbors
-
-    # Pick nearest image that is NOT the original
-    nearest_img_by_comment = None
-    for idx in I[0]:
-        candidate_id = image_ids[idx]
-        if candidate_id != id_:
-            nearest_img_by_comment = candidate_id
-            break
-
-    # If all neighbors are the original (unlikely), fallback to original
-    if nearest_img_by_comment is None:
-        nearest_img_by_comment = id_
+for (id_, prompt), nearest_row in zip(items, nearest.tolist()):
+    # nearest admissible image, which is never the original; fall back to the original if there is none
+    nearest_img_by_comment = image_ids[nearest_row] if nearest_row >= 0 else id_
 
     # -----------------------------
     # PAIR WITH ORIGINAL IMAGE
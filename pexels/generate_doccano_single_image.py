@@ -1,9 +1,13 @@
 import json
 import os
+import sys
 from glob import glob
 from tqdm import tqdm
 import random
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_catalog import read_catalog, catalog_path, catalog_is_stale
+
 DATASET_PREFIX = "pexels"
 PROMPTS_JSON_PATH = "/var/tmp/deckersn/pexels/pexels-110k-768p-min-jpg/pexels-prompts-pairs.json"
 IMAGE_DIR = "/var/tmp/deckersn/pexels/pexels-110k-768p-min-jpg/images"
@@ -18,7 +22,11 @@ records = []
 with open(PROMPTS_JSON_PATH, 'r') as file:
     prompt_lines = json.load(file)
 
-id_dict = {f.split(".")[0].split("-")[-1]: f for f in os.listdir(IMAGE_DIR)}
+# file names by pexels id from the image catalog; create or update it first with
+#   python ../image_catalog.py pexels <IMAGE_DIR>
+if catalog_is_stale(IMAGE_DIR):
+    print(f"[WARN] {IMAGE_DIR} changed since its image catalog was last updated")
+id_dict = {entry["id"]: entry["name"] for entry in read_catalog(catalog_path(IMAGE_DIR))}
 
 
 for line in tqdm(prompt_lines, desc="Prompts"):
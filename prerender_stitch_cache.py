@@ -0,0 +1,153 @@
+import os
+import json
+import argparse
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from werkzeug.exceptions import HTTPException
+
+import image_stitch_server as server
+
+# -------- CLI --------
+parser = argparse.ArgumentParser(description="Render stitched composites for Doccano JSONL files into the on-disk stitch cache")
+parser.add_argument("jsonl_files", nargs="+", help="doccano_*.jsonl files whose im_url values should be pre-rendered")
+parser.add_argument("--cache-dir", default=server.STITCH_CACHE_DIR, help="Target directory (must match STITCH_CACHE_DIR of the server)")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of render processes")
+parser.add_argument("--max-width", type=int, help="Render thumbnails of this width (as requested via ?max_width=)")
+parser.add_argument("--max-height", type=int, help="Render thumbnails of this height (as requested via ?max_height=)")
+parser.add_argument("--prune", action="store_true",
+                    help="Delete cached composites that the given files (at the given thumbnail size) do not need, e.g. of since changed sources")
+parser.add_argument("--max-bytes", type=int,
+                    help="Afterwards delete the oldest cached composites until the cache directory is at most this large")
+
+
+def split_request(im_url):
+    """Strip scheme and host, returning the `dataset/a.jpg+dataset/b.jpg` part and the query parameters."""
+    url = urlsplit(im_url)
+    return url.path.lstrip("/"), dict(parse_qsl(url.query))
+
+
+def render_to_disk(image_paths, max_width, max_height, out_path):
+    data, _ = server.render_composite(image_paths, max_width, max_height)
+
+    # write atomically so that the server never reads a half-written file
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return len(data)
+
+
+def cached_files(cache_dir):
+    """(path, size, mtime) of every composite in the cache directory."""
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith(".jpg"):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                files.append((path, st.st_size, st.st_mtime))
+    return files
+
+
+def evict(cache_dir, needed, prune, max_bytes):
+    """Delete composites not in `needed` (with prune), then the oldest ones beyond max_bytes."""
+    files = cached_files(cache_dir)
+    deleted = freed = 0
+    if prune:
+        kept = []
+        for path, size, mtime in files:
+            if os.path.normpath(path) in needed:
+                kept.append((path, size, mtime))
+                continue
+            os.remove(path)
+            deleted += 1
+            freed += size
+        files = kept
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in sorted(files, key=lambda f: f[2]):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            deleted += 1
+            freed += size
+    print(f"Deleted {deleted} cached composites ({freed / 1e6:.1f} MB) from {cache_dir}")
+
+
+def main():
+    args = parser.parse_args()
+    server.STITCH_CACHE_DIR = args.cache_dir
+
+    urls = []
+    seen = set()
+    for path in args.jsonl_files:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                im_url = json.loads(line).get("im_url")
+                if not im_url:
+                    continue
+                filename, query = split_request(im_url)
+                if args.max_width is not None:
+                    query.setdefault("max_width", str(args.max_width))
+                if args.max_height is not None:
+                    query.setdefault("max_height", str(args.max_height))
+                key = (filename, tuple(sorted(query.items())))
+                if key not in seen:
+                    seen.add(key)
+                    urls.append((filename, query))
+
+    print(f"Found {len(urls)} distinct urls in {len(args.jsonl_files)} file(s)")
+
+    jobs = []
+    needed = set()  # cache files of the current sources
+    up_to_date = 0
+    invalid = 0
+    for filename, query in urls:
+        try:
+            image_paths, cache_key = server.resolve_image_paths(filename)
+            max_width, max_height = server.parse_thumbnail_size(query)
+        except HTTPException as e:
+            print(f"Skipping {filename}: {e.description}")
+            invalid += 1
+            continue
+
+        # single full-size images are served from the source file directly
+        if len(image_paths) == 1 and max_width is None and max_height is None:
+            up_to_date += 1
+            continue
+
+        out_path = server.disk_cache_path(server.sized_cache_key(cache_key, max_width, max_height))
+        needed.add(os.path.normpath(out_path))
+        if os.path.exists(out_path):
+            up_to_date += 1
+            continue
+        jobs.append((image_paths, max_width, max_height, out_path))
+
+    print(f"{up_to_date} already rendered, {invalid} invalid, {len(jobs)} to render")
+
+    failed = 0
+    total_bytes = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(render_to_disk, *job): job[-1] for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering"):
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                print(f"Failed to render {futures[future]}: {e}")
+                failed += 1
+
+    print(f"Rendered {len(jobs) - failed} composites ({total_bytes / 1e6:.1f} MB) into {args.cache_dir}, {failed} failed")
+
+    # composites are keyed on source mtimes and sizes, so every edited source leaves an orphan behind
+    if args.prune or args.max_bytes is not None:
+        evict(args.cache_dir, needed, args.prune, args.max_bytes)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
 import os
+import sys
 import torch
 import faiss
 import numpy as np
-from PIL import Image
 from tqdm import tqdm
-from transformers import CLIPProcessor, CLIPModel
-import pickle
+from transformers import CLIPProcessor, CLIPModel, AutoTokenizer
 import json
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from clip_embedding import MODEL_NAME, ImageDataset, embed_images, embed_texts, embed_images_parallel, embed_texts_parallel
+from clip_embedding import load_backend, check_image_backend, check_text_backend, accept_backend
+from faiss_index import write_approx_index
+from knn_table import write_knn_table
+from embedding_store import save_embeddings, EmbeddingStore, EmbeddingCache, PixelCache, hash_files
+
 # -----------------------------
 # CONFIG
 # -----------------------------
@@ -17,16 +23,61 @@ COMMENTS_DIR = "output/comments"
 IMAGE_INDEX_FILE = "faiss_image_index.index"
 TEXT_INDEX_FILE = "faiss_text_index.index"
 
-IMAGE_EMBEDDINGS_FILE = "image_embeddings.pkl"
-TEXT_EMBEDDINGS_FILE = "text_embeddings.pkl"
+# approximate indices saved next to the flat ones (as e.g. faiss_image_index.hnsw32.index), given as
+# faiss.index_factory strings such as "IVF1024,Flat", "IVF1024,PQ64" or "HNSW32" (see faiss_index.py)
+APPROX_INDEX_TYPES = []
+INDEX_TRAIN_SIZE = 65536  # vectors sampled to train IVF indices
+
+# exact top-KNN_TABLE_K neighbour tables for the generate_doccano_*.py scripts, image -> image and
+# text -> image, computed with blocked matrix products (0: no tables, the scripts search instead)
+KNN_TABLE_K = 32
+IMAGE_KNN_PREFIX = "knn_image_image"
+TEXT_KNN_PREFIX = "knn_text_image"
+
+# embedding stores: <prefix>.npy matrix, <prefix>_ids.json keys, <prefix>_lookup.npy hash -> row
+IMAGE_EMBEDDINGS_PREFIX = "image_embeddings"
+TEXT_EMBEDDINGS_PREFIX = "text_embeddings"
+EMBEDDING_DTYPE = "float32"  # "float16" halves the stores; FAISS still gets float32
+
+# embeddings checkpointed in shards, keyed by image content / text hash and model name, so that
+# reruns only embed new or changed items and interrupted runs resume from the last shard
+EMBEDDING_CACHE_DIR = "embedding_cache"
+CACHE_SHARD_SIZE = 4096
+# keep the preprocessed images (resized and cropped uint8 pixels, ~150 KB each) in one memory-mapped
+# file under EMBEDDING_CACHE_DIR, so that runs that have to re-embed them (new model weights or
+# backend) do not decode the images again
+PIXEL_CACHE = False
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+IMAGE_BATCH_SIZE = 64
+LOADER_WORKERS = min(8, os.cpu_count())  # processes decoding and preprocessing images ahead of the model
+TEXT_BATCH_SIZE = 256
+
+# CPU only: with EMBED_PROCESSES > 1, images and texts are split over that many worker processes
+# with TORCH_THREADS_PER_PROCESS torch threads each (None: cores // EMBED_PROCESSES)
+EMBED_PROCESSES = 1
+TORCH_THREADS_PER_PROCESS = None
+
+# CPU only: "int8" (dynamically quantized linear layers) or "torchscript" (traced graphs) instead of
+# the fp32 model. They are only used for images / texts if their embeddings of a sample agree with fp32.
+BACKEND = "fp32"
+BACKEND_CHECK_SAMPLE = 256
+BACKEND_MIN_COSINE = 0.99  # lowest cosine similarity to the fp32 embedding of the same item
+BACKEND_MIN_TOP1 = 0.95  # share of sample items with the same nearest neighbour as with fp32
+
 # -----------------------------
 # LOAD CLIP MODEL
 # -----------------------------
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(DEVICE)
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+if EMBED_PROCESSES > 1 and DEVICE == "cpu":
+    # the workers are forked from this process, which therefore must not start OpenMP threads itself
+    torch.set_num_threads(1)
+
+model = CLIPModel.from_pretrained(MODEL_NAME).to(DEVICE)
+processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+
+backend_model = load_backend(model, BACKEND) if BACKEND != "fp32" and DEVICE == "cpu" else None
 
 # -----------------------------
 # STEP 1: EMBED IMAGES
@@ -34,42 +85,45 @@ processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 print("Embedding images...")
 image_paths = [os.path.join(IMAGE_DIR, f) for f in os.listdir(IMAGE_DIR) if f.endswith("_image.jpg")]
 
-image_embeddings_dict = {}  # id -> embedding
-image_ids = []
+image_ids = [os.path.basename(img_path).split("_image.jpg")[0] for img_path in image_paths]
 
-for img_path in tqdm(image_paths, desc="Images"):
-    id_ = os.path.basename(img_path).split("_image.jpg")[0]
-    image_ids.append(id_)
+# unchanged files (same size and mtime) are not read again for hashing
+image_hashes = hash_files(image_paths, memo_file=os.path.join(EMBEDDING_CACHE_DIR, "file_hashes.json"))
+image_model, image_backend = model, "fp32"
+if backend_model is not None:
+    agreement = check_image_backend(model, backend_model, ImageDataset(image_paths, processor), BACKEND_CHECK_SAMPLE, IMAGE_BATCH_SIZE)
+    if accept_backend(BACKEND, agreement, BACKEND_MIN_COSINE, BACKEND_MIN_TOP1, "images"):
+        image_model, image_backend = backend_model, BACKEND
 
-    image = Image.open(img_path).convert("RGB")
-    inputs = processor(images=image, return_tensors="pt").to(DEVICE)
-    with torch.no_grad():
-        embedding = model.get_image_features(**inputs)["pooler_output"]
-        embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-    image_embeddings_dict[id_] = embedding.cpu().numpy().flatten()  # store as 1D array
+image_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, MODEL_NAME, "images", CACHE_SHARD_SIZE, image_backend)
+crop_size = processor.image_processor.crop_size["height"]
+pixel_cache = PixelCache(os.path.join(EMBEDDING_CACHE_DIR, f"pixels_{crop_size}"), crop_size) if PIXEL_CACHE else None
 
-# Build FAISS index
-image_embeddings_array = np.stack(list(image_embeddings_dict.values())).astype("float32")
-d = image_embeddings_array.shape[1]
-image_index = faiss.IndexFlatIP(d)
-image_index.add(image_embeddings_array)
+if EMBED_PROCESSES > 1 and DEVICE == "cpu":
+    embeddings = embed_images_parallel(image_model, ImageDataset(image_paths, processor), image_hashes, image_cache, EMBED_PROCESSES, TORCH_THREADS_PER_PROCESS, IMAGE_BATCH_SIZE, pixel_cache)
+else:
+    embeddings = embed_images(image_model, ImageDataset(image_paths, processor), DEVICE, IMAGE_BATCH_SIZE, LOADER_WORKERS, cache=image_cache, keys=image_hashes, pixel_cache=pixel_cache)
 
-# Map index positions to IDs
-image_id_list = list(image_embeddings_dict.keys())
+# Save the embeddings (row i belongs to image_ids[i]) and build the FAISS index from the mapped matrix
+save_embeddings(IMAGE_EMBEDDINGS_PREFIX, image_ids, embeddings, EMBEDDING_DTYPE)
+image_store = EmbeddingStore(IMAGE_EMBEDDINGS_PREFIX)
 
-# Save everything
+image_index = faiss.IndexFlatIP(image_store.matrix.shape[1])
+image_index.add(image_store.float32_matrix())
 faiss.write_index(image_index, IMAGE_INDEX_FILE)
-with open(IMAGE_EMBEDDINGS_FILE, "wb") as f:
-    pickle.dump(image_embeddings_dict, f)
+for index_type in APPROX_INDEX_TYPES:
+    write_approx_index(image_store.float32_matrix(), IMAGE_INDEX_FILE, index_type, INDEX_TRAIN_SIZE)
 
-print(f"Saved image index ({IMAGE_INDEX_FILE}) and embeddings dict ({IMAGE_EMBEDDINGS_FILE})")
+print(f"Saved image index ({IMAGE_INDEX_FILE}) and embeddings ({IMAGE_EMBEDDINGS_PREFIX}.npy)")
+if KNN_TABLE_K:
+    write_knn_table(IMAGE_KNN_PREFIX, image_store, image_store, KNN_TABLE_K)
 
 # -----------------------------
 # STEP 2: EMBED COMMENT TEXTS
 # -----------------------------
 print("Embedding comment texts...")
 
-text_embeddings_dict = {}  # text string -> embedding
+bodies = []
 
 for comment_file in tqdm(os.listdir(COMMENTS_DIR), desc="Comments"):
     if not comment_file.endswith("_comments.jsonl"):
@@ -81,37 +135,35 @@ for comment_file in tqdm(os.listdir(COMMENTS_DIR), desc="Comments"):
         for line in f:
             comment = json.loads(line)
             body = comment.get("body", "").strip()
-            if not body:
-                continue
-
-            inputs = processor(
-                text=body,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,   # truncate to model max
-                max_length=77
-            ).to(DEVICE)
-            
-            with torch.no_grad():
-                embedding = model.get_text_features(**inputs)["pooler_output"]
-                embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-            text_embeddings_dict[body] = embedding.cpu().numpy().flatten()
+            if body:
+                bodies.append(body)
+
+# text string -> embedding, duplicates embedded once, truncated to the model max of 77 tokens
+text_model, text_backend = model, "fp32"
+if backend_model is not None and bodies:
+    agreement = check_text_backend(model, backend_model, tokenizer, bodies, BACKEND_CHECK_SAMPLE, TEXT_BATCH_SIZE)
+    if accept_backend(BACKEND, agreement, BACKEND_MIN_COSINE, BACKEND_MIN_TOP1, "texts"):
+        text_model, text_backend = backend_model, BACKEND
+
+text_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, MODEL_NAME, "texts", CACHE_SHARD_SIZE, text_backend)
+if EMBED_PROCESSES > 1 and DEVICE == "cpu":
+    text_embeddings_dict = embed_texts_parallel(text_model, tokenizer, bodies, text_cache, EMBED_PROCESSES, TORCH_THREADS_PER_PROCESS, TEXT_BATCH_SIZE)
+else:
+    text_embeddings_dict = embed_texts(text_model, tokenizer, bodies, DEVICE, TEXT_BATCH_SIZE, cache=text_cache)
 
 # Build FAISS index for text
 if text_embeddings_dict:
-    text_embeddings_array = np.stack(list(text_embeddings_dict.values())).astype("float32")
-    d_text = text_embeddings_array.shape[1]
-    text_index = faiss.IndexFlatIP(d_text)
-    text_index.add(text_embeddings_array)
-    
-    # Map index positions to text
-    text_id_list = list(text_embeddings_dict.keys())
+    save_embeddings(TEXT_EMBEDDINGS_PREFIX, text_embeddings_dict.keys(), np.stack(list(text_embeddings_dict.values())), EMBEDDING_DTYPE)
+    text_store = EmbeddingStore(TEXT_EMBEDDINGS_PREFIX)
 
-    # Save
+    text_index = faiss.IndexFlatIP(text_store.matrix.shape[1])
+    text_index.add(text_store.float32_matrix())
     faiss.write_index(text_index, TEXT_INDEX_FILE)
-    with open(TEXT_EMBEDDINGS_FILE, "wb") as f:
-        pickle.dump(text_embeddings_dict, f)
+    for index_type in APPROX_INDEX_TYPES:
+        write_approx_index(text_store.float32_matrix(), TEXT_INDEX_FILE, index_type, INDEX_TRAIN_SIZE)
 
-    print(f"Saved text index ({TEXT_INDEX_FILE}) and embeddings dict ({TEXT_EMBEDDINGS_FILE})")
+    print(f"Saved text index ({TEXT_INDEX_FILE}) and embeddings ({TEXT_EMBEDDINGS_PREFIX}.npy)")
+    if KNN_TABLE_K:
+        write_knn_table(TEXT_KNN_PREFIX, text_store, image_store, KNN_TABLE_K)
 else:
     print("No comment texts found. Skipping text index.")
@@ -0,0 +1,153 @@
+import os
+import json
+import sqlite3
+from tqdm import tqdm
+
+# Single-file SQLite copy of output/meta and output/comments for the generate_doccano_*.py
+# scripts, which read it with one query instead of opening two files per submission.
+# match_comments_submissions.py, remove_by_blocklist.py and remove_duplicates.py rewrite it
+# after changing the per-file layout, which stays the primary export; run
+#   python comments_store.py
+# to rebuild it by hand, e.g. for an output directory of an earlier version. load_submissions
+# also rebuilds it when a file in output/meta or output/comments is newer than the store.
+#
+#   submissions  one row per _meta.json, in directory listing order (`position`), with the
+#                meta object, its fields, the number of comments (NULL without a comments
+#                file) and the top comment: the first comment with the highest numeric score
+#                (comments without one are never the top comment)
+#   comments     one row per comment line, in file order
+
+STORE_FILE = "comments.sqlite"
+
+SCHEMA = """
+CREATE TABLE submissions (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    image_url TEXT,
+    submission_body TEXT,
+    submission_score INTEGER,
+    num_comments INTEGER,
+    top_comment_id TEXT,
+    top_comment_score REAL,
+    top_comment_body TEXT
+);
+CREATE TABLE comments (
+    submission_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    id TEXT,
+    score INTEGER,
+    body TEXT
+);
+CREATE INDEX comments_submission ON comments (submission_id, position);
+"""
+
+
+def store_path(out_dir="output"):
+    return os.path.join(out_dir, STORE_FILE)
+
+
+def numeric_score(comment):
+    """The score of a comment as float, or None if it has none or it is not numeric."""
+    score = comment.get("score")
+    if score is None:
+        return None
+    try:
+        return float(score)
+    except (ValueError, TypeError):
+        return None
+
+
+def build_store(out_dir="output"):
+    """Rewrite <out_dir>/comments.sqlite from <out_dir>/meta and <out_dir>/comments."""
+    meta_dir = os.path.join(out_dir, "meta")
+    comments_dir = os.path.join(out_dir, "comments")
+    path = store_path(out_dir)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    con = sqlite3.connect(tmp_path)
+    con.executescript(SCHEMA)
+    meta_files = [f for f in os.listdir(meta_dir) if f.endswith("_meta.json")]
+    for position, meta_file in enumerate(tqdm(meta_files, desc="Comments store")):
+        id_ = meta_file.split("_meta.json")[0]
+        with open(os.path.join(meta_dir, meta_file), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        comments = None
+        top = None
+        comments_file = os.path.join(comments_dir, f"{id_}_comments.jsonl")
+        if os.path.exists(comments_file):
+            comments = []
+            top_score = float("-inf")
+            with open(comments_file, "r", encoding="utf-8") as f:
+                for i, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        comment = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        print(f"[ERROR] JSON decode error in {comments_file} line {i}: {e}")
+                        continue
+                    comments.append((id_, len(comments), comment.get("id"), comment.get("score"), comment.get("body", "")))
+                    score = numeric_score(comment)
+                    if score is not None and score > top_score:
+                        top, top_score = comment, score
+            con.executemany("INSERT INTO comments VALUES (?, ?, ?, ?, ?)", comments)
+
+        con.execute("INSERT INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            id_, position, json.dumps(meta, ensure_ascii=False),
+            meta.get("image_url"), meta.get("submission_body"), meta.get("submission_score"),
+            None if comments is None else len(comments),
+            top and top.get("id"), top and top_score, top and top.get("body", ""),
+        ))
+    con.commit()
+    con.close()
+    os.replace(tmp_path, path)
+    print(f"Wrote {len(meta_files)} submissions to {path}")
+
+
+def newest_mtime(directory):
+    """Latest mtime (ns) of a directory and the files in it, which catches additions, removals and edits."""
+    newest = os.stat(directory).st_mtime_ns
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            newest = max(newest, entry.stat().st_mtime_ns)
+    return newest
+
+
+def store_is_stale(out_dir="output"):
+    """True if there is no store or <out_dir>/meta or <out_dir>/comments changed after it was written."""
+    path = store_path(out_dir)
+    if not os.path.exists(path):
+        return True
+    store_time = os.stat(path).st_mtime_ns
+    return any(
+        os.path.isdir(directory) and newest_mtime(directory) > store_time
+        for directory in (os.path.join(out_dir, "meta"), os.path.join(out_dir, "comments"))
+    )
+
+
+def load_submissions(out_dir="output"):
+    """All submissions as dicts (columns of the submissions table, meta parsed), in listing order.
+
+    Builds the store first if there is none yet or the per-file layout changed since.
+    """
+    path = store_path(out_dir)
+    if store_is_stale(out_dir):
+        print(f"{path} is missing or older than the per-file layout, building it")
+        build_store(out_dir)
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    try:
+        rows = [dict(row) for row in con.execute("SELECT * FROM submissions ORDER BY position")]
+    finally:
+        con.close()
+    for row in rows:
+        row["meta"] = json.loads(row["meta"])
+    return rows
+
+
+if __name__ == "__main__":
+    build_store()
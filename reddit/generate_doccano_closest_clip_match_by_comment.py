@@ -1,110 +1,112 @@
 import os
+import sys
 import json
 import random
-import pickle
-import faiss
-import numpy as np
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from embedding_store import EmbeddingStore
+from faiss_index import load_index
+from knn_table import load_knn_table
+from hard_negatives import HardNegatives, exclusion_labels, load_groups
+from comments_store import load_submissions
+
 # -----------------------------
 # CONFIG
 # -----------------------------
 DATASET_PREFIX = "reddit"
-META_DIR = "output/meta"
-COMMENTS_DIR = "output/comments"
+OUTPUT_DIR = "output"  # submissions and comments are read from its comments.sqlite (see comments_store.py)
 OUTPUT_FILE = f"doccano_{DATASET_PREFIX}_closest_clip_match_by_comment.jsonl"
 SWAP_LOG_FILE = f"groundtruth_{DATASET_PREFIX}_closest_clip_match_by_comment.json"
 GAMMA_DOMAIN = "http://gammaweb09.medien.uni-weimar.de:8080"
 SEED = 42
 
 IMAGE_INDEX_FILE = "faiss_image_index.index"
-IMAGE_EMBEDDINGS_FILE = "image_embeddings.pkl"
-TEXT_EMBEDDINGS_FILE = "text_embeddings.pkl"
+IMAGE_INDEX_TYPE = "Flat"  # or one of the APPROX_INDEX_TYPES of build_index.py, e.g. "HNSW32"
+NPROBE = 16  # IVF cells visited per query
+EF_SEARCH = 64  # HNSW candidates kept per query
+SEARCH_CHUNK_SIZE = 16384  # comments searched per FAISS call
+IMAGE_EMBEDDINGS_PREFIX = "image_embeddings"
+TEXT_EMBEDDINGS_PREFIX = "text_embeddings"
+
+# distractor choice (see hard_negatives.py): the NEGATIVE_RANK-th closest admissible image (0: the
+# hardest) with a similarity in [NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY] (None: no bound)
+# among the NEGATIVE_SEARCH_K nearest images of the text; raise NEGATIVE_SEARCH_K along with
+# the rank, a band or exclusion groups
+NEGATIVE_SEARCH_K = 2
+NEGATIVE_RANK = 0
+NEGATIVE_MIN_SIMILARITY = None
+NEGATIVE_MAX_SIMILARITY = None
+EXCLUSION_GROUPS_FILE = None  # JSON list of lists of image ids never paired with each other, e.g. "output/near_duplicate_groups.json"
+
+# neighbour table precomputed by build_index.py (KNN_TABLE_K); the FAISS index is only loaded and
+# searched without a current table with at least NEGATIVE_SEARCH_K neighbours (None: always search)
+KNN_TABLE_PREFIX = "knn_text_image"
 
 random.seed(SEED)
 
 # -----------------------------
 # LOAD EMBEDDINGS
 # -----------------------------
-with open(IMAGE_EMBEDDINGS_FILE, "rb") as f:
-    image_embeddings_dict = pickle.load(f)
-image_ids = list(image_embeddings_dict.keys())
-image_embeddings_array = np.stack(list(image_embeddings_dict.values())).astype("float32")
-
-with open(TEXT_EMBEDDINGS_FILE, "rb") as f:
-    text_embeddings_dict = pickle.load(f)
-text_ids = list(text_embeddings_dict.keys())
-text_embeddings_array = np.stack(list(text_embeddings_dict.values())).astype("float32")
+image_store = EmbeddingStore(IMAGE_EMBEDDINGS_PREFIX)  # memory-mapped, row i belongs to image_ids[i]
+image_ids = image_store.keys
+text_store = EmbeddingStore(TEXT_EMBEDDINGS_PREFIX)  # texts are resolved to rows by hash, the text table is never loaded
 
 # -----------------------------
-# LOAD FAISS INDICES
+# LOAD NEIGHBOUR TABLE OR IMAGE FAISS INDEX
 # -----------------------------
-image_index = faiss.read_index(IMAGE_INDEX_FILE)
-
-# Build image ID → index position mapping for FAISS results
-image_id_to_idx = {id_: i for i, id_ in enumerate(image_ids)}
+knn_table = load_knn_table(KNN_TABLE_PREFIX, TEXT_EMBEDDINGS_PREFIX, IMAGE_EMBEDDINGS_PREFIX, NEGATIVE_SEARCH_K) if KNN_TABLE_PREFIX else None
+image_index = load_index(IMAGE_INDEX_FILE, IMAGE_INDEX_TYPE, NPROBE, EF_SEARCH) if knn_table is None else None
 
 # -----------------------------
-# GENERATE JSONL
+# COLLECT TOP COMMENTS
 # -----------------------------
-lines = []
-swap_log = {}
-counter = 0
-
-for meta_file in tqdm(os.listdir(META_DIR), desc="Processing meta files"):
-    if not meta_file.endswith("_meta.json"):
-        continue
-
-    id_ = meta_file.split("_meta.json")[0]
-
-    # Load meta
-    meta_path = os.path.join(META_DIR, meta_file)
-    with open(meta_path, "r") as f:
-        meta_data = json.load(f)
-    meta_score = meta_data.get("score", 0)
+items = []  # (id, top comment, meta score) of the submissions to pair
+query_rows = []  # text store row of each top comment
+source_rows = []  # image store row of each submission
 
-    # Load top comment
-    comments_file = os.path.join(COMMENTS_DIR, f"{id_}_comments.jsonl")
-    if not os.path.exists(comments_file):
-        continue
+for submission in tqdm(load_submissions(OUTPUT_DIR), desc="Processing submissions"):
+    id_ = submission["id"]
+    meta_score = submission["meta"].get("score", 0)
 
-    top_comment_text = None
-    top_comment_score = float("-inf")
-    top_comment_raw = None
-    with open(comments_file, "r") as f:
-        for line in f:
-            comment = json.loads(line)
-            score = comment.get("score", 0)
-            if score > top_comment_score:
-                top_comment_score = score
-                top_comment_text = comment.get("body", "")
-                top_comment_raw = comment.get("body", "")
+    # top comment, precomputed by comments_store.py
+    top_comment_text = submission["top_comment_body"]
+    top_comment_raw = submission["top_comment_body"]
 
     if not top_comment_text:
         continue
 
-    # -----------------------------
-    # FIND IMAGE MATCH FOR COMMENT
-    # -----------------------------
-    if top_comment_raw not in text_embeddings_dict or id_ not in image_embeddings_dict:
+    text_row = text_store.row(top_comment_raw)
+    image_row = image_store.row(id_)
+    if text_row is None or image_row is None:
         continue
 
-    comment_emb = text_embeddings_dict[top_comment_raw].reshape(1, -1).astype("float32")
+    items.append((id_, top_comment_text, meta_score))
+    query_rows.append(text_row)
+    source_rows.append(image_row)
 
-    # Search nearest image by comment embedding
-    D, I = image_index.search(comment_emb, k=2)  # get top 2 neighbors
+# -----------------------------
+# FIND IMAGE MATCH FOR EACH COMMENT
+# -----------------------------
+# neighbours of all comments from the table, or one batched search in chunks of SEARCH_CHUNK_SIZE
+labels = exclusion_labels(image_ids, load_groups(EXCLUSION_GROUPS_FILE)) if EXCLUSION_GROUPS_FILE else None
+if knn_table is not None:
+    negatives = HardNegatives.from_table(knn_table, query_rows, NEGATIVE_SEARCH_K, source_rows, labels)
+else:
+    negatives = HardNegatives.search(image_index, text_store.matrix, query_rows, NEGATIVE_SEARCH_K, source_rows, labels, SEARCH_CHUNK_SIZE)
+nearest, _ = negatives.pick(NEGATIVE_RANK, NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY)
+negatives.shortfall(nearest)
 
-    # Pick nearest image that is NOT the original
-    nearest_img_by_comment = None
-    for idx in I[0]:
-        candidate_id = image_ids[idx]
-        if candidate_id != id_:
-            nearest_img_by_comment = candidate_id
-            break
+# -----------------------------
+# GENERATE JSONL
+# -----------------------------
+lines = []
+swap_log = {}
+counter = 0
 
-    # If all neighbors are the original (unlikely), fallback to original
-    if nearest_img_by_comment is None:
-        nearest_img_by_comment = id_
+for (id_, top_comment_text, meta_score), nearest_row in zip(items, nearest.tolist()):
+    # nearest admissible image, which is never the original; fall back to the original if there is none
+    nearest_img_by_comment = image_ids[nearest_row] if nearest_row >= 0 else id_
 
     # -----------------------------
     # PAIR WITH ORIGINAL IMAGE
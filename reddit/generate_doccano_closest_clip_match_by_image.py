@@ -1,45 +1,76 @@
 import os
+import sys
 import json
 import random
-import pickle
-import faiss
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from embedding_store import EmbeddingStore
+from faiss_index import load_index
+from knn_table import load_knn_table
+from hard_negatives import HardNegatives, exclusion_labels, load_groups
+from comments_store import load_submissions
+
 # -----------------------------
 # CONFIG
 # -----------------------------
 DATASET_PREFIX = "reddit"
-META_DIR = "output/meta"
-COMMENTS_DIR = "output/comments"
+OUTPUT_DIR = "output"  # submissions and comments are read from its comments.sqlite (see comments_store.py)
 OUTPUT_FILE = f"doccano_{DATASET_PREFIX}_closest_clip_match_by_image.jsonl"
 SWAP_LOG_FILE = f"groundtruth_{DATASET_PREFIX}_closest_clip_match_by_image.json"
 GAMMA_DOMAIN = "http://gammaweb09.medien.uni-weimar.de:8080"
 SEED = 42
 
 IMAGE_INDEX_FILE = "faiss_image_index.index"
-IMAGE_EMBEDDINGS_FILE = "image_embeddings.pkl"
+IMAGE_INDEX_TYPE = "Flat"  # or one of the APPROX_INDEX_TYPES of build_index.py, e.g. "HNSW32"
+NPROBE = 16  # IVF cells visited per query
+EF_SEARCH = 64  # HNSW candidates kept per query
+SEARCH_CHUNK_SIZE = 16384  # images searched per FAISS call
+IMAGE_EMBEDDINGS_PREFIX = "image_embeddings"
+
+# distractor choice (see hard_negatives.py): the NEGATIVE_RANK-th closest admissible image (0: the
+# hardest) with a similarity in [NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY] (None: no bound)
+# among the NEGATIVE_SEARCH_K nearest images (including the image itself); raise NEGATIVE_SEARCH_K
+# along with the rank, a band or exclusion groups
+NEGATIVE_SEARCH_K = 2
+NEGATIVE_RANK = 0
+NEGATIVE_MIN_SIMILARITY = None
+NEGATIVE_MAX_SIMILARITY = None
+EXCLUSION_GROUPS_FILE = None  # JSON list of lists of image ids never paired with each other, e.g. "output/near_duplicate_groups.json"
+
+# neighbour table precomputed by build_index.py (KNN_TABLE_K); the FAISS index is only loaded and
+# searched without a current table with at least NEGATIVE_SEARCH_K neighbours (None: always search)
+KNN_TABLE_PREFIX = "knn_image_image"
 
 random.seed(SEED)
 
 # -----------------------------
 # LOAD IMAGE EMBEDDINGS
 # -----------------------------
-with open(IMAGE_EMBEDDINGS_FILE, "rb") as f:
-    image_embeddings_dict = pickle.load(f)
-image_ids = list(image_embeddings_dict.keys())
-image_embeddings_array = np.stack(list(image_embeddings_dict.values())).astype("float32")
+image_store = EmbeddingStore(IMAGE_EMBEDDINGS_PREFIX)  # memory-mapped, row i belongs to image_ids[i]
+image_ids = image_store.keys
 
 # -----------------------------
-# LOAD IMAGE FAISS INDEX
+# LOAD NEIGHBOUR TABLE OR IMAGE FAISS INDEX
 # -----------------------------
-image_index = faiss.read_index(IMAGE_INDEX_FILE)
+knn_table = load_knn_table(KNN_TABLE_PREFIX, IMAGE_EMBEDDINGS_PREFIX, IMAGE_EMBEDDINGS_PREFIX, NEGATIVE_SEARCH_K) if KNN_TABLE_PREFIX else None
+image_index = load_index(IMAGE_INDEX_FILE, IMAGE_INDEX_TYPE, NPROBE, EF_SEARCH) if knn_table is None else None
 
 # -----------------------------
 # FIND NEAREST IMAGE FOR EACH IMAGE
 # -----------------------------
-# k=2 because nearest neighbor includes self
-distances, neighbors = image_index.search(image_embeddings_array, k=2)
-nearest_dict = {image_ids[i]: image_ids[neighbors[i][1]] for i in range(len(image_ids))}
+image_rows = np.arange(len(image_ids))
+labels = exclusion_labels(image_ids, load_groups(EXCLUSION_GROUPS_FILE)) if EXCLUSION_GROUPS_FILE else None
+if knn_table is not None:
+    negatives = HardNegatives.from_table(knn_table, image_rows, NEGATIVE_SEARCH_K, source_rows=image_rows, labels=labels)
+else:
+    # one more neighbour for an approximate index, which may rank self lower or miss it
+    k = NEGATIVE_SEARCH_K if IMAGE_INDEX_TYPE == "Flat" else NEGATIVE_SEARCH_K + 1
+    negatives = HardNegatives.search(image_index, image_store.matrix, image_rows, k, source_rows=image_rows, labels=labels, chunk_size=SEARCH_CHUNK_SIZE)
+nearest, _ = negatives.pick(NEGATIVE_RANK, NEGATIVE_MIN_SIMILARITY, NEGATIVE_MAX_SIMILARITY)
+negatives.shortfall(nearest)
+# an image without an admissible neighbour is paired with itself
+nearest_dict = {image_ids[i]: image_ids[j if j >= 0 else i] for i, j in enumerate(nearest.tolist())}
 
 # -----------------------------
 # BUILD JSONL
@@ -48,32 +79,14 @@ lines = []
 swap_log = {}
 counter = 0
 
-for meta_file in os.listdir(META_DIR):
-    if not meta_file.endswith("_meta.json"):
-        continue
-
-    id_ = meta_file.split("_meta.json")[0]
+for submission in load_submissions(OUTPUT_DIR):
+    id_ = submission["id"]
+    meta_score = submission["meta"].get("score", 0)
 
-    # Load meta
-    meta_path = os.path.join(META_DIR, meta_file)
-    with open(meta_path, "r") as f:
-        meta_data = json.load(f)
-    meta_score = meta_data.get("score", 0)
-
-    # Load top comment (highest "score") for this image
-    comments_file = os.path.join(COMMENTS_DIR, f"{id_}_comments.jsonl")
-    if not os.path.exists(comments_file):
+    # top comment (highest "score") for this image, precomputed by comments_store.py
+    if submission["num_comments"] is None:  # no comments file
         continue
-
-    top_comment_text = None
-    top_comment_score = float("-inf")
-    with open(comments_file, "r") as f:
-        for line in f:
-            comment = json.loads(line)
-            score = comment.get("score", 0)
-            if score > top_comment_score:
-                top_comment_score = score
-                top_comment_text = comment.get("body", "")
+    top_comment_text = submission["top_comment_body"]
 
     # Get nearest image ID
     id2 = nearest_dict.get(id_, id_)
@@ -1,60 +1,32 @@
 import json
-import os
-from glob import glob
+from comments_store import load_submissions
 
 DATASET_PREFIX = "reddit"
-META_DIR = "output/meta"
-COMMENTS_DIR = "output/comments"
+OUTPUT_DIR = "output"  # submissions and comments are read from its comments.sqlite (see comments_store.py)
 OUTPUT_FILE = f"doccano_{DATASET_PREFIX}_single_image.jsonl"
 BASE_URL = "http://gammaweb09.medien.uni-weimar.de:8080"
 
-def load_jsonl(path):
-    with open(path, "r", encoding="utf-8") as f:
-        for i, line in enumerate(f, 1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                yield json.loads(line)
-            except json.JSONDecodeError as e:
-                print(f"[ERROR] JSON decode error in {path} line {i}: {e}")
-
 records = []
 
-meta_files = glob(os.path.join(META_DIR, "*_meta.json"))
-print(f"[DEBUG] Found {len(meta_files)} meta files")
+submissions = load_submissions(OUTPUT_DIR)
+print(f"[DEBUG] Found {len(submissions)} submissions")
 
-for meta_path in meta_files:
-    id_ = os.path.basename(meta_path).replace("_meta.json", "")
+for submission in submissions:
+    id_ = submission["id"]
     print(f"\n[DEBUG] Processing ID={id_}")
 
-    comments_path = os.path.join(COMMENTS_DIR, f"{id_}_comments.jsonl")
-    if not os.path.exists(comments_path):
-        print(f"[WARN] Missing comments file: {comments_path}")
+    if submission["num_comments"] is None:
+        print(f"[WARN] Missing comments file for ID={id_}")
         continue
 
-    best_comment = None
-    best_score = float("-inf")
-
-    for entry in load_jsonl(comments_path):
-        score = entry.get("score")
-        if score is None:
-            continue
-        # make sure score is numeric
-        try:
-            score = float(score)
-        except (ValueError, TypeError):
-            continue
-        if score > best_score:
-            best_score = score
-            best_comment = entry
-
-    if not best_comment or not best_comment.get("body"):
+    # top comment, precomputed by comments_store.py
+    best_score = submission["top_comment_score"]
+    if not submission["top_comment_body"]:
         print(f"[WARN] No usable comment for ID={id_}")
         continue
 
     records.append({
-        "text": best_comment["body"],
+        "text": submission["top_comment_body"],
         "im_url": f"{BASE_URL}/{DATASET_PREFIX}/{id_}_image.jpg",
         "score": best_score  # keep score for sorting
     })
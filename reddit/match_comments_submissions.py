@@ -1,10 +1,15 @@
 import os
+import sys
 import json
 import requests
 import pandas as pd
 from io import BytesIO
 from PIL import Image, UnidentifiedImageError
 from tqdm import tqdm
+from comments_store import build_store
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_catalog import update_catalog
 
 # -------------------------
 # Config
@@ -174,3 +179,8 @@ for _, submission in tqdm(
     meta_out = os.path.join(META_DIR, f"{sid}_meta.json")
     with open(meta_out, "w", encoding="utf-8") as f:
         json.dump(meta, f, ensure_ascii=False, indent=2)
+
+# single-file copy of meta and comments for the generate_doccano_*.py scripts
+build_store(OUT_DIR)
+# sizes, dimensions and hashes of the new images for the stitch server and remove_duplicates.py
+update_catalog(IMG_DIR, "reddit")
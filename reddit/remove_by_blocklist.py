@@ -1,8 +1,14 @@
+import os
+import sys
 import json
 import re
 import shutil
 import argparse
 from pathlib import Path
+from comments_store import build_store
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_catalog import update_catalog
 
 # -------- CLI --------
 parser = argparse.ArgumentParser()
@@ -140,4 +146,7 @@ for comments_file in COMMENTS_DIR.glob("*_comments.jsonl"):
                 shutil.move(str(meta_path), str(REMOVED_DIR / meta_path.name))
 
 if PREVIEW:
-    log("\n✔ Preview complete — no files were modified.")
\ No newline at end of file
+    log("\n✔ Preview complete — no files were modified.")
+else:
+    build_store(str(OUTPUT_DIR))  # keep comments.sqlite in line with the files
+    update_catalog(IMAGES_DIR, "reddit")  # drop the moved images
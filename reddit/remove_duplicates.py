@@ -1,29 +1,38 @@
-from PIL import Image
-import imagehash
+import os
+import sys
+import numpy as np
 from pathlib import Path
 from collections import defaultdict
 from tqdm import tqdm
+from comments_store import build_store, numeric_score
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_catalog import update_catalog, read_catalog, catalog_path
 
 IMAGE_DIR = Path("output/images")
-HASH_FN = imagehash.phash  # phash is most robust to scaling
+# phash (most robust to scaling) of every image, from output/image_catalog.sqlite; the update
+# only decodes images that are new or changed since the last run (see image_catalog.py)
 THRESHOLD = 5  # max Hamming distance for "duplicate"
+# groups of images whose hashes differ in 1..THRESHOLD bits; they are kept, but the Doccano
+# generators can be told not to pair them (EXCLUSION_GROUPS_FILE, see hard_negatives.py)
+NEAR_DUPLICATES_FILE = Path("output/near_duplicate_groups.json")
+
+update_catalog(IMAGE_DIR, "reddit")
 
 hashes = {}
 
-for img_path in tqdm(IMAGE_DIR.glob("*")):
-    try:
-        with Image.open(img_path) as img:
-            h = HASH_FN(img)
-            hashes[img_path] = h
-    except Exception as e:
-        print(f"Skipping {img_path}: {e}")
+for entry in read_catalog(catalog_path(IMAGE_DIR)):
+    if entry["phash"] is None:
+        print(f"Skipping {IMAGE_DIR / entry['name']}: {entry['error']}")
+        continue
+    hashes[IMAGE_DIR / entry["name"]] = entry["phash"]
 
 
 from collections import defaultdict
 
 buckets = defaultdict(list)
 for path, h in tqdm(hashes.items()):
-    buckets[str(h)].append(path)
+    buckets[h].append(path)
 
 for h, imgs in tqdm(buckets.items()):
     if len(imgs) > 1:
@@ -35,6 +44,31 @@ collision_groups = [
     if len(imgs) > 1
 ]
 
+# near duplicates among the images that are kept (the first of each bucket), compared in blocks
+kept = [imgs[0] for imgs in buckets.values()]
+bits = np.array([int(hashes[p], 16) for p in kept], dtype=np.uint64)
+popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+parent = list(range(len(kept)))
+
+def find(i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+for start in tqdm(range(0, len(bits), 256), desc="Near duplicates"):
+    xor = bits[start:start + 256, None] ^ bits[None, :]
+    distance = popcount[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=2)
+    for i, j in zip(*np.nonzero(distance <= THRESHOLD)):
+        if start + i < j:
+            parent[find(start + i)] = find(j)
+
+near_groups = defaultdict(list)
+for i, path in enumerate(kept):
+    near_groups[find(i)].append(path.stem.split("_")[0])
+near_groups = [group for group in near_groups.values() if len(group) > 1]
+print(f"{len(near_groups)} groups of near duplicates (up to {THRESHOLD} bits apart) written to {NEAR_DUPLICATES_FILE}")
+
 
 
 from pathlib import Path
@@ -45,6 +79,9 @@ BASE = Path("output")
 DUP_DIR = BASE / "duplicates"
 DUP_DIR.mkdir(exist_ok=True)
 
+with open(NEAR_DUPLICATES_FILE, "w", encoding="utf-8") as f:
+    json.dump(near_groups, f)
+
 def load_jsonl(path):
     with open(path, "r", encoding="utf-8") as f:
         return [json.loads(line) for line in f]
@@ -54,6 +91,11 @@ def write_jsonl(path, records):
         for r in records:
             f.write(json.dumps(r, ensure_ascii=False) + "\n")
 
+def comment_rank(comment):
+    # comments without a numeric score go last
+    score = numeric_score(comment)
+    return float("-inf") if score is None else score
+
 def move_or_copy(src: Path, dst: Path, copy: bool):
     if not src.exists():
         return
@@ -88,6 +130,9 @@ for group in collision_groups:
             if dup_comments_path.exists():
                 canonical_comments.extend(load_jsonl(dup_comments_path))
 
-    # sort merged comments by score (descending)
-    canonical_comments.sort(key=lambda x: x.get("score", 0), reverse=True)
-    write_jsonl(canonical_comments_path, canonical_comments)
\ No newline at end of file
+    # sort merged comments by score (descending), ranked like the top comment of comments_store.py
+    canonical_comments.sort(key=comment_rank, reverse=True)
+    write_jsonl(canonical_comments_path, canonical_comments)
+
+build_store(str(BASE))  # keep comments.sqlite in line with the files
+update_catalog(IMAGE_DIR, "reddit")  # drop the moved duplicates
@@ -0,0 +1,58 @@
+import os
+import sys
+import threading
+from concurrent.futures import Future
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import image_stitch_server as server
+
+
+class DoneExecutor:
+    """Runs the task in submit(), so the future is already done when the callback is added."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def render_in_thread(pool, *args):
+    result = {}
+
+    def run():
+        try:
+            result["value"] = pool.render(*args)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive(), "render deadlocked"
+    return result
+
+
+def test_render_of_done_future_does_not_deadlock(monkeypatch):
+    monkeypatch.setattr(server, "render_composite", lambda paths, w, h: (b"jpeg", {"encode": 0.0}))
+    cache = server.StitchCache(1024)
+    pool = server.RenderPool(DoneExecutor(), 4, cache)
+
+    result = render_in_thread(pool, ("key",), ["a.jpg"])
+    assert result["value"] == (b"jpeg", {"encode": 0.0})
+    assert cache.get(("key",)) == b"jpeg"
+    assert pool.stats()["pending"] == 0
+
+
+def test_failed_done_future_releases_inflight_entry(monkeypatch):
+    def fail(paths, w, h):
+        raise FileNotFoundError(paths[0])
+
+    monkeypatch.setattr(server, "render_composite", fail)
+    pool = server.RenderPool(DoneExecutor(), 4, server.StitchCache(1024))
+
+    result = render_in_thread(pool, ("key",), ["missing.jpg"])
+    assert isinstance(result["error"], FileNotFoundError)
+    assert pool.stats()["pending"] == 0